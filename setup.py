@@ -12,7 +12,6 @@ setup(
     install_requires=[
         "pyyaml",
         "pwntools",
-        "termcolor",
-        "tqdm"
+        "termcolor"
     ]
 )
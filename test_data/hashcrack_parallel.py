@@ -0,0 +1,66 @@
+# Example program for brute-forcing the hash of a 6-digit PIN code, split
+# across several worker processes which all stop once any of them finds it
+import hashlib
+import multiprocessing
+import sys
+
+tgt_hash = sys.argv[1].lower()
+outfile = sys.argv[2]
+workers = int(sys.argv[3]) if len(sys.argv) > 3 else multiprocessing.cpu_count()
+
+# 6-digit PIN codes
+MAX = 999999+1
+
+# how often each worker checks whether another has found the PIN
+CHECK_EVERY = 10000
+
+def search(worker, found, result, progress):
+    # each worker takes every n-th PIN, so all of them cover the whole range evenly
+    for n, i in enumerate(range(worker, MAX, workers)):
+        if n % CHECK_EVERY == 0:
+            if found.is_set():
+                return
+
+            with progress.get_lock():
+                progress.value += CHECK_EVERY if n > 0 else 0
+
+        pincode = "{:06d}".format(i)
+
+        if hashlib.sha256(pincode.encode()).hexdigest() == tgt_hash:
+            result.value = i
+            found.set()
+            return
+
+if __name__ == "__main__":
+    print(f"Searching with {workers} workers")
+
+    found = multiprocessing.Event()
+    result = multiprocessing.Value("i", -1)
+    progress = multiprocessing.Value("i", 0)
+
+    procs = [multiprocessing.Process(target=search, args=(i, found, result, progress)) for i in range(workers)]
+    for p in procs:
+        p.start()
+
+    last_percentage = 0
+    while any(p.is_alive() for p in procs):
+        found.wait(1)
+
+        percentage = int(100 * progress.value / MAX)
+        if percentage != last_percentage and not found.is_set():
+            print(f"progress = {percentage}%", flush=True)
+            last_percentage = percentage
+
+    for p in procs:
+        p.join()
+
+    if result.value >= 0:
+        pincode = "{:06d}".format(result.value)
+        print("FOUND", pincode)
+        with open(outfile, "w+") as f:
+            f.write(f"FOUND = {pincode}")
+        sys.exit(0)
+
+    print("No result found")
+    with open(outfile, "w+") as f:
+        f.write("No result found")
@@ -6,3 +6,7 @@ if not os.path.exists(SELF_DIR): os.mkdir(SELF_DIR)
 
 MACHINES_YAML = os.path.expanduser("~/.tinymon/machines.yaml")
 JOBMGR_YAML = os.path.expanduser("~/.tinymon/job_manager.yaml")
+JOBMGR_LOCK = os.path.expanduser("~/.tinymon/job_manager.lock")
+HEALTH_YAML = os.path.expanduser("~/.tinymon/health.yaml")
+HEALTH_LOCK = os.path.expanduser("~/.tinymon/health.lock")
+STATUS_CACHE_YAML = os.path.expanduser("~/.tinymon/status_cache.yaml")
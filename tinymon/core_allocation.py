@@ -0,0 +1,72 @@
+"""
+core_allocation.py
+
+Assigns physical CPU cores to jobs, so that jobs sharing a machine are
+each pinned to their own cores rather than competing for the same ones.
+A job reserving a core gets all of its hardware threads.
+"""
+from dataclasses import dataclass
+
+# Lists "cpu,core,socket" for each hardware thread, followed by whether
+# taskset is available to pin jobs to them
+TOPOLOGY_CMD = "lscpu -p=CPU,CORE,SOCKET; command -v taskset > /dev/null && echo taskset"
+
+@dataclass
+class CoreTopology:
+    cores: list # the hardware thread IDs of each physical core
+    has_taskset: bool
+
+    @classmethod
+    def parse(cls, out):
+        cores = {}
+        has_taskset = False
+
+        for line in out.splitlines():
+            line = line.strip()
+            if line == "taskset":
+                has_taskset = True
+                continue
+
+            fields = line.split(",")
+            if line.startswith("#") or len(fields) != 3 or not all(x.isdigit() for x in fields): continue
+
+            cpu, core, socket = [int(x) for x in fields]
+            cores.setdefault((socket, core), []).append(cpu)
+
+        assert len(cores) > 0, "Failed to determine the machine's CPU topology"
+        return cls([sorted(cores[k]) for k in sorted(cores)], has_taskset)
+
+    @classmethod
+    def populate(cls, ssh):
+        out, _ = ssh.run_to_end(TOPOLOGY_CMD)
+        if not isinstance(out, str): out = out.decode()
+
+        return cls.parse(out)
+
+    # Picks `count` of the cores not in `reserved`, preferring consecutive
+    # cores so a job stays within one socket where possible. Returns None
+    # if there are not enough free cores.
+    def allocate(self, count, reserved):
+        free = [i for i in range(len(self.cores)) if i not in reserved]
+        if len(free) < count:
+            return None
+
+        for start in range(len(free) - count + 1):
+            run = free[start:start+count]
+            if run[-1] - run[0] == count - 1:
+                return run
+
+        return free[:count]
+
+    # The hardware thread IDs of the given cores, as a taskset CPU list
+    def cpu_list(self, cores):
+        return ",".join(str(cpu) for i in sorted(cores) for cpu in self.cores[i])
+
+# Unit-test
+if __name__ == "__main__":
+    topo = CoreTopology.parse("# CPU,Core,Socket\n0,0,0\n1,1,0\n2,2,0\n3,3,0\n4,0,0\n5,1,0\n6,2,0\n7,3,0\ntaskset\n")
+    print(topo)
+
+    cores = topo.allocate(2, {1})
+    print(cores, topo.cpu_list(cores))
+    print(topo.allocate(4, {1}))
@@ -0,0 +1,236 @@
+"""
+garbage_collect.py
+
+Finds and removes the directories left behind on machines by jobs which
+have completed or are no longer tracked (run-<jid>-work/, run-<jid>-tmp/,
+run-<jid>-src/, run-<jid>-stage/, workflow artifacts-<jid>/ and leftover
+upload tarballs),
+either deleting them or archiving them into a compressed tarball.
+"""
+from dataclasses import dataclass
+from .machine_access import get_access, UPLOAD_TARBALL_PREFIX
+from .machine_config import DirType, MachineType
+from .machine_groups import fan_out, report_errors
+from .table_display import display_table
+import os
+import re
+import shlex
+import time
+
+_RUN_DIR = re.compile(r"^(?:run-([0-9]+)-(?:work|tmp|src|stage)|artifacts-([0-9]+))$")
+
+@dataclass
+class StaleEntry:
+    machine: str
+    path: str
+    size_kb: int
+    age: float # seconds
+    jid: int # None for upload tarballs
+    synced: bool = False # for staging directories, whether the job's results were synced out of it
+
+# Parses durations such as 30m, 12h, or 7d into seconds
+def parse_duration(x):
+    m = re.fullmatch(r"([0-9]+)([smhd]?)", x)
+    assert m, f"Invalid duration {x}, must be i.e. 30m, 12h, or 7d"
+    return int(m.group(1)) * {"": 1, "s": 1, "m": 60, "h": 3600, "d": 86400}[m.group(2)]
+
+# Parses sizes such as 512K, 100M, or 1G into kilobytes
+def parse_size(x):
+    m = re.fullmatch(r"([0-9]+)([KMG]?)", x)
+    assert m, f"Invalid size {x}, must be i.e. 512K, 100M, or 1G"
+    return int(m.group(1)) * {"": 1, "K": 1, "M": 1024, "G": 1024*1024}[m.group(2)]
+
+def format_size(kb):
+    for unit in ["K", "M", "G"]:
+        if kb < 1024:
+            return f"{kb:.1f}{unit}"
+        kb /= 1024
+
+    return f"{kb:.1f}T"
+
+def _format_age(seconds):
+    if seconds >= 86400:
+        return f"{int(seconds // 86400)}d"
+    if seconds >= 3600:
+        return f"{int(seconds // 3600)}h"
+
+    return f"{int(seconds // 60)}m"
+
+# Lists the run directories in a machine's workdir and tmpdir, along with
+# any tarballs left in its temporary directory by uploads, with one command.
+# Staging directories whose results have been synced into the workdir are
+# also listed after "synced".
+def _list_cmd(machine):
+    marker = shlex.quote(machine.workdir) + "\"/run-$jid-src/results_synced\""
+
+    cmds = []
+    for base in dict.fromkeys([machine.workdir, machine.tmpdir]):
+        cmds.append(f"(cd {shlex.quote(base)} 2>/dev/null && "
+                    f"for d in run-*-work run-*-tmp run-*-src run-*-stage artifacts-*; do "
+                    f"[ -e \"$d\" ] && echo \"$(du -sk \"$d\" 2>/dev/null | cut -f1) $(stat -c %Y \"$d\") $PWD/$d\"; done; "
+                    f"for d in run-*-stage; do jid=${{d#run-}}; jid=${{jid%-stage}}; "
+                    f"[ -e \"$d\" ] && [ -f {marker} ] && echo \"synced $PWD/$d\"; done; true)")
+
+    # only tarballs named by tinymon, as other programs use the same directory
+    cmds.append(f"for f in $(find \"${{TMPDIR:-/tmp}}\" -maxdepth 1 -name '{UPLOAD_TARBALL_PREFIX}*.tar.gz' "
+                f"-user \"$(id -un)\" 2>/dev/null); do "
+                "echo \"$(du -sk \"$f\" | cut -f1) $(stat -c %Y \"$f\") $f\"; done")
+
+    return "; ".join(cmds) + "; true"
+
+def _list_machine(machine):
+    with get_access(machine, skip_unhealthy=True) as m:
+        out, status = m.run_to_end(_list_cmd(machine))
+
+    if not isinstance(out, str): out = out.decode()
+    assert status == 0, f"Failed to list directories: {out}"
+
+    entries = []
+    synced = set()
+    for line in out.splitlines():
+        if line.startswith("synced "):
+            synced.add(line[len("synced "):])
+            continue
+
+        fields = line.split(" ", 2)
+        if len(fields) != 3 or not fields[0].isdigit() or not fields[1].isdigit(): continue
+
+        match = _RUN_DIR.match(os.path.basename(fields[2].rstrip("/")))
+        jid = int(match.group(1) or match.group(2)) if match else None
+        entries.append(StaleEntry(machine.name, fields[2], int(fields[0]), time.time() - int(fields[1]), jid))
+
+    for entry in entries:
+        entry.synced = entry.path in synced
+
+    return entries
+
+# Whether an entry should be collected. Directories of active jobs, jobs
+# waiting to be relaunched, and anything an active job's command refers to
+# are always kept, as are staging directories which may hold the only copy
+# of a job's results. Directories of jobs which this copy of tinymon does
+# not track (i.e. other users' jobs in a shared workdir) may still be
+# running, so they are only collected with `include_untracked`.
+def _is_stale(entry, jm, older_than, min_size, include_untracked=False):
+    if entry.size_kb < min_size:
+        return False
+
+    for job in jm.list().values():
+        if job["active"] and _refers_to(job["start_cmd"], entry.path):
+            return False
+
+    state = jm.get(entry.jid) if entry.jid is not None else None
+    if entry.jid is not None and state is None and not include_untracked:
+        return False
+
+    if _is_stagedir(entry) and not entry.synced and not (state is not None and state.get("synced")):
+        return False
+
+    if state is not None:
+        if state["active"] or (state.get("requeue_at") and not state.get("requeued_as")):
+            return False
+
+        # tracked jobs age from when they finished, rather than last modified
+        entry.age = time.time() - (state.get("end_time") or state["start_time"])
+
+    return entry.age >= older_than
+
+# Whether a command refers to the path (or anything within it) as a whole,
+# so that i.e. run-12-work does not match run-123-work
+def _refers_to(cmd, path):
+    path = path.rstrip("/")
+    return re.search(r"(?<![^\s'\"=:])" + re.escape(path) + r"(?![^\s'\"/;:)])", cmd) is not None
+
+def _is_stagedir(entry):
+    return entry.jid is not None and entry.path.rstrip("/").endswith(f"run-{entry.jid}-stage")
+
+# Removes (or archives) the given entries, returning the ones which failed
+def _collect_machine(machine, entries, archive):
+    archive_dir = os.path.join(machine.workdir, "tinymon-archive")
+
+    cmds = []
+    for entry in entries:
+        path = shlex.quote(entry.path.rstrip("/"))
+
+        if archive and entry.jid is not None:
+            dest = shlex.quote(os.path.join(archive_dir, os.path.basename(entry.path.rstrip("/")) + ".tar.gz"))
+            cmd = f"mkdir -p {shlex.quote(archive_dir)} && " \
+                  f"tar -C $(dirname {path}) -czf {dest} $(basename {path}) && rm -rf -- {path}"
+        else:
+            cmd = f"rm -rf -- {path}"
+
+        cmds.append(f"{{ {cmd}; }} || echo {shlex.quote('failed ' + entry.path)}")
+
+    with get_access(machine) as m:
+        out, _ = m.run_to_end("; ".join(cmds))
+
+    if not isinstance(out, str): out = out.decode()
+    failed = [line[len("failed "):] for line in out.splitlines() if line.startswith("failed ")]
+    return [entry for entry in entries if entry.path in failed]
+
+def gc_run(machines, names, jm, older_than=7*86400, min_size=0, dry_run=False, archive=False,
+           include_untracked=False):
+    listed = fan_out(names, lambda name: _list_machine(machines[name]))
+
+    # directories in a shared workdir (or on this machine, for local
+    # machines) are listed by every machine which shares them, but only
+    # need to be collected once
+    seen = set()
+    stale = {}
+    for name, (entries, err) in listed.items():
+        if err is not None: continue
+
+        machine = machines[name]
+        for entry in entries:
+            # the sync marker is removed along with run-<jid>-src, so it is
+            # also recorded for any later runs which still find the staging
+            # directory
+            if entry.synced and jm.get(entry.jid) is not None and not jm.get(entry.jid).get("synced"):
+                jm.update(entry.jid, synced=True)
+
+            if machine.machine_type == MachineType.LOCAL:
+                key = ("local", entry.path)
+            elif machine.workdir_type in (DirType.SHARED_DISK, DirType.AFS) and \
+                 entry.path.startswith(machine.workdir):
+                key = ("shared", entry.path)
+            else:
+                key = (name, entry.path)
+
+            if key in seen or not _is_stale(entry, jm, older_than, min_size, include_untracked): continue
+            seen.add(key)
+            stale.setdefault(name, []).append(entry)
+
+    rows = []
+    total = 0
+    for name, entries in stale.items():
+        for entry in entries:
+            rows.append([name, entry.path, format_size(entry.size_kb), _format_age(entry.age)])
+            total += entry.size_kb
+
+    if len(rows) > 0:
+        display_table("Stale Directories", ["Machine", "Path", "Size", "Age"], rows)
+
+    if dry_run:
+        print(f"Would reclaim {format_size(total)} from {len(rows)} directories")
+        report_errors("Unreachable Machines", listed)
+        return stale
+
+    results = fan_out(list(stale), lambda name: _collect_machine(machines[name], stale[name], archive))
+
+    reclaimed = 0
+    for name, (failed, err) in results.items():
+        if err is not None: continue
+
+        if len(failed) > 0:
+            results[name] = (None, Exception(f"Failed to remove {', '.join(x.path for x in failed)}"))
+
+        for entry in stale[name]:
+            if entry in failed: continue
+
+            reclaimed += entry.size_kb
+            if entry.jid is not None and jm.get(entry.jid) is not None:
+                jm.update(entry.jid, collected=True)
+
+    print(f"{'Archived' if archive else 'Reclaimed'} {format_size(reclaimed)}")
+    report_errors("Unreachable Machines", listed)
+    report_errors("Failed to Collect", results)
+    return stale
@@ -5,24 +5,130 @@ Provides a data structure JobConfig for maintaining the information
 about a job that can be run on a machine
 """
 from dataclasses import dataclass
+import hashlib
+import os
+import yaml
+import re
+
+# Seconds a machine can be unreachable before its jobs are lost, unless the
+# job's retry policy sets its own
+DEFAULT_HOST_TIMEOUT = 300
+
+# Opt-in policy for relaunching a job which was lost along with its machine
+@dataclass
+class RetryPolicy:
+    max_attempts: int
+    backoff: float # seconds before the first relaunch, doubling after each
+    host_timeout: float # seconds a machine can be unreachable before its jobs are lost
+    checkpoint: str # path within the results dir to carry over when relaunching
+    machines: list # machines to relaunch on, or None for any
+
+    @classmethod
+    def parseconfig(cls, cfg):
+        assert "max_attempts" in cfg, "Retry policies must have a 'max_attempts' parameter"
+        assert int(cfg["max_attempts"]) >= 1, "Retry policies must allow at least one attempt"
+
+        return cls(int(cfg["max_attempts"]), float(cfg.get("backoff", 60)),
+                   float(cfg.get("host_timeout", DEFAULT_HOST_TIMEOUT)), cfg.get("checkpoint", None),
+                   cfg.get("machines", None))
+
+# Size-capped rotation of a job's stdout and stderr on the remote machine
+@dataclass
+class LogConfig:
+    max_size: str # maximum size of each log file, i.e. 10M
+    keep: int # number of log files to keep for each stream
+    compress: bool
+
+    @classmethod
+    def parseconfig(cls, cfg):
+        max_size = str(cfg.get("max_size", "10M"))
+        assert re.fullmatch(r"[0-9]+[KMG]?", max_size), "Log 'max_size' must be a size such as 512K, 10M, or 1G"
+        assert int(cfg.get("keep", 5)) >= 1, "Log 'keep' must be at least 1"
+
+        return cls(max_size, int(cfg.get("keep", 5)), bool(cfg.get("compress", False)))
+
+# Python virtualenv which a job runs in, built once and cached on each
+# machine (or shared filesystem) for every job with the same spec
+@dataclass
+class EnvConfig:
+    python: str # interpreter to create the virtualenv with
+    requirements: list # pip requirement specifiers
+    requirements_file: str # path to a requirements.txt, relative to the job YAML
+
+    @classmethod
+    def parseconfig(cls, cfg):
+        assert "requirements" in cfg or "requirements_file" in cfg, \
+                "Environments must have a 'requirements' or 'requirements_file' parameter"
+
+        return cls(str(cfg.get("python", "python3")), [str(x) for x in cfg.get("requirements", [])],
+                   cfg.get("requirements_file", None))
+
+    # The contents of the requirements.txt to install, from both the
+    # inline requirements and the requirements file
+    def get_requirements(self, jobdir):
+        lines = list(self.requirements)
+
+        if self.requirements_file:
+            with open(os.path.join(jobdir, self.requirements_file)) as f:
+                lines += [x.strip() for x in f.read().splitlines()]
+
+        return "\n".join(x for x in lines if x and not x.startswith("#")) + "\n"
+
+    # Identifies the virtualenv by everything which affects its contents.
+    # `runtime` describes the interpreter on the machine, so machines
+    # sharing a filesystem only share virtualenvs if they are compatible.
+    def get_key(self, jobdir, runtime):
+        spec = f"{self.python}\n{runtime}\n{self.get_requirements(jobdir)}"
+        return hashlib.sha256(spec.encode()).hexdigest()[:16]
 
 @dataclass
 class JobConfig:
     name: str
     entry_cmd: str
     results_dir_remote: str
+    retry: RetryPolicy = None
+    logging: LogConfig = None
+    environment: EnvConfig = None
+    staging: bool = False # run with {workdir} on the tmpdir, syncing the results back after
+    cores: int = None # physical cores to reserve and pin the job to
+    nice: int = None
 
     @classmethod
     def parseconfig(cls, cfg):
         assert "name" in cfg, "Jobs must have a 'name' parameter"
         assert "entry_cmd" in cfg, "Jobs must have a 'entry_cmd' parameter"
 
-        return cls(cfg["name"], cfg["entry_cmd"], cfg.get("results_dir_remote", None))
+        retry = RetryPolicy.parseconfig(cfg["retry"]) if "retry" in cfg else None
+        if retry and retry.checkpoint:
+            assert "results_dir_remote" in cfg, "Jobs with a checkpoint must have a 'results_dir_remote' parameter"
+
+        logging = LogConfig.parseconfig(cfg["logging"] or {}) if "logging" in cfg else None
+
+        environment = EnvConfig.parseconfig(cfg["environment"]) if "environment" in cfg else None
+
+        staging = bool(cfg.get("staging", False))
+        if staging:
+            assert "{workdir}" in cfg.get("results_dir_remote", ""), \
+                    "Jobs with staging must have a 'results_dir_remote' within {workdir}"
+
+        cores = int(cfg["cores"]) if "cores" in cfg else None
+        assert cores is None or cores >= 1, "Jobs must reserve at least one core"
+
+        nice = int(cfg["nice"]) if "nice" in cfg else None
+        assert nice is None or 0 <= nice <= 19, "Job 'nice' must be between 0 and 19"
+
+        return cls(cfg["name"], cfg["entry_cmd"], cfg.get("results_dir_remote", None), retry, logging,
+                   environment, staging, cores, nice)
+
+    @classmethod
+    def parsefile(cls, path):
+        with open(path) as f:
+            data = yaml.load(f, yaml.Loader)
+
+        return cls.parseconfig(data)
 
 # Unit-test
 if __name__ == "__main__":
-    import yaml
-
     with open("test_data/sleep-30.yaml") as f:
         data = yaml.load(f, yaml.Loader)
 
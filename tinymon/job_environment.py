@@ -0,0 +1,71 @@
+"""
+job_environment.py
+
+Builds the Python virtualenvs which jobs run in. Each virtualenv is built
+once in the machine's workdir, under tinymon-envs/ and named by the hash of
+its spec, and reused by every later job with the same spec. Machines which
+share a workdir (i.e. on AFS) also share virtualenvs, as long as their
+interpreters are compatible.
+"""
+from . import tracing
+import os
+import shlex
+
+READY_MARKER = ".tinymon-ready"
+STALE_LOCK_MINUTES = 60
+
+def get_env_root(machine):
+    return os.path.join(machine.workdir, "tinymon-envs")
+
+# Describes the interpreter on the machine, i.e. "3.10.12 x86_64 glibc2.35"
+def get_runtime(m, env):
+    probe = "import sys, platform; print(sys.version.split()[0], platform.machine(), ''.join(platform.libc_ver()))"
+    out, status = m.run_to_end(f"{env.python} -c {shlex.quote(probe)}")
+
+    if not isinstance(out, str): out = out.decode()
+    assert status == 0, f"Failed to run {env.python}: {out.strip()}"
+    return out.strip()
+
+# Builds the virtualenv unless it has already been built. Concurrent
+# launches serialize on a lock directory, and the virtualenv is only
+# marked as ready once it is complete, so one left half-built by a crash
+# is rebuilt rather than used.
+def _build_cmd(env, env_dir, requirements):
+    d = shlex.quote(env_dir)
+    lock = shlex.quote(env_dir + ".lock")
+    ready = shlex.quote(os.path.join(env_dir, READY_MARKER))
+    pip = shlex.quote(os.path.join(env_dir, "bin", "pip"))
+    reqs = shlex.quote(os.path.join(env_dir, "requirements.txt"))
+
+    return "; ".join([
+        f"[ -f {ready} ] && echo cached && exit 0",
+        f"mkdir -p {shlex.quote(os.path.dirname(env_dir))} || exit 1",
+        f"while ! mkdir {lock} 2>/dev/null; do "
+            f"[ -f {ready} ] && echo cached && exit 0; "
+            f"[ -n \"$(find {lock} -maxdepth 0 -mmin +{STALE_LOCK_MINUTES} 2>/dev/null)\" ] && rmdir {lock}; "
+            f"sleep 5; done",
+        f"if [ -f {ready} ]; then echo cached; status=0; "
+            f"else rm -rf {d} && {env.python} -m venv {d} && "
+            f"printf %s {shlex.quote(requirements)} > {reqs} && "
+            f"{pip} install --quiet --disable-pip-version-check -r {reqs} && "
+            f"touch {ready} && echo built; status=$?; fi",
+        f"rmdir {lock}",
+        "exit $status",
+    ])
+
+# Returns the path of the job's virtualenv on the machine, building it if needed
+def prepare_env(m, machine, env, jobdir):
+    runtime = get_runtime(m, env)
+    key = env.get_key(jobdir, runtime)
+    env_dir = os.path.join(get_env_root(machine), key)
+
+    with tracing.span("prepare_env", machine.name, key=key) as s:
+        out, status = m.run_to_end("sh -c " + shlex.quote(_build_cmd(env, env_dir, env.get_requirements(jobdir))))
+
+        if not isinstance(out, str): out = out.decode(errors="replace")
+        assert status == 0, f"Failed to build environment {key} on {machine.name}: {out.strip()}"
+
+        s["cached"] = out.strip().endswith("cached")
+
+    print(f"{'Using cached' if s['cached'] else 'Built'} environment {key} ({runtime})")
+    return env_dir
@@ -8,6 +8,9 @@ from dataclasses import dataclass
 from .job_config import JobConfig
 from .machine_config import MachineConfig
 import os
+import shlex
+
+MACHINE_VARS = ["cores", "threads", "mem_gb"]
 
 @dataclass
 class JobInstance:
@@ -15,6 +18,10 @@ class JobInstance:
     machine: MachineConfig
     jid: int
     args: dict
+    env_dir: str = None # virtualenv to run in, if the job has an environment
+    cores: list = None # physical cores reserved for the job
+    cpus: str = None # CPU list to pin the job to with taskset
+    machine_vars: dict = None # {cores}, {threads}, and {mem_gb} of the machine
 
     def get_jobdir(self):
         return os.path.join(self.machine.workdir, f"run-{self.jid}-work/")
@@ -25,6 +32,24 @@ class JobInstance:
     def get_data_dir(self):
         return os.path.join(self.machine.workdir, f"run-{self.jid}-src/")
 
+    # With staging, {workdir} is on the machine's tmpdir while the job runs
+    def get_stagedir(self):
+        return os.path.join(self.machine.tmpdir, f"run-{self.jid}-stage/")
+
+    def get_workdir(self):
+        return self.get_stagedir() if self.config.staging else self.get_jobdir()
+
+    # Created once the results have been synced back from the staging
+    # directory, so its absence means they are still only on the tmpdir
+    def get_sync_marker(self):
+        return os.path.join(self.get_data_dir(), "results_synced")
+
+    # Written atomically with the exit code and end time once the job
+    # finishes, so its presence marks the job as complete
+    def get_status_file(self):
+        return os.path.join(self.get_data_dir(), "exit_status")
+
+    # Where the results are kept once the job has finished
     def get_results_dir(self):
         if self.config.results_dir_remote:
             return self.config.results_dir_remote.replace(r"{tmpdir}", self.get_tmpdir())\
@@ -32,13 +57,83 @@ class JobInstance:
         else:
             return None
 
+    # Where the job writes its results while it runs
+    def get_staged_results_dir(self):
+        if self.config.results_dir_remote:
+            return self.config.results_dir_remote.replace(r"{tmpdir}", self.get_tmpdir())\
+                                            .replace(r"{workdir}", self.get_workdir())
+        else:
+            return None
+
     def get_entry_cmd(self):
         cmd = self.config.entry_cmd.replace(r"{tmpdir}", self.get_tmpdir())\
-                               .replace(r"{workdir}", self.get_jobdir())
+                               .replace(r"{workdir}", self.get_workdir())
 
-        cmd = cmd.format(**self.args)
+        cmd = cmd.format(**{**(self.machine_vars or {}), **self.args})
         return cmd
 
+    # Whether the entry command refers to any of the machine's specs
+    def uses_machine_vars(self):
+        return any("{" + x + "}" in self.config.entry_cmd for x in MACHINE_VARS)
+
+    # Wraps the entry command so that it records its exit status, and
+    # rotates its logs if requested
+    def get_wrapped_cmd(self):
+        status = shlex.quote(self.get_status_file())
+        record = f"echo \"$(cat {status}.rc) $(date +%s)\" > {status}.tmp; mv {status}.tmp {status}"
+
+        entry = self.get_entry_cmd()
+        if self.env_dir is not None:
+            env_dir = shlex.quote(self.env_dir)
+            entry = f"export VIRTUAL_ENV={env_dir} PATH={env_dir}/bin:\"$PATH\"; {entry}"
+
+        # the exit status is only recorded after the results are synced, so
+        # a job which completed always has its results in the workdir
+        if self.config.staging:
+            record = f"{self.get_sync_cmd()} || {{ [ \"$(cat {status}.rc)\" != 0 ] || echo 1 > {status}.rc; }}; {record}"
+
+        if self.config.logging is None:
+            script = f"( {entry} ); echo $? > {status}.rc; {record}"
+        else:
+            # stderr is swapped onto fd 3 so each stream gets its own rotation
+            script = f"{{ {{ ( {entry} ); echo $? > {status}.rc; }} 2>&3 | " \
+                     f"{self._rotate_cmd('stdout')}; }} 3>&1 | {self._rotate_cmd('stderr')}; {record}"
+
+        cmd = "sh -c " + shlex.quote(script)
+
+        if self.config.nice is not None:
+            cmd = f"nice -n {self.config.nice} {cmd}"
+        if self.cpus is not None:
+            cmd = f"taskset -c {self.cpus} {cmd}"
+
+        return cmd
+
+    def get_sync_cmd(self):
+        return sync_cmd(self.get_staged_results_dir(), self.get_results_dir(), self.get_sync_marker(),
+                        self.get_stagedir())
+
+    # Splits a stream into numbered log files in the working directory,
+    # keeping only the most recent ones
+    def _rotate_cmd(self, stream):
+        log = self.config.logging
+        prune = f"ls -1 {stream}.log.* 2>/dev/null | head -n -{log.keep - 1} | xargs rm -f"
+        write = "gzip -c > \"$FILE.gz\"" if log.compress else "cat > \"$FILE\""
+
+        return f"split -C {log.max_size} -d -a 6 --filter={shlex.quote(prune + '; ' + write)} - {stream}.log."
+
+
+# Copies the staged results into the workdir with a single bulk copy. They
+# are copied alongside and then moved into place, so the results dir never
+# holds a partial copy, and the marker is only created once they are in
+# place. The staging directory is then removed.
+def sync_cmd(staged, results, marker, stagedir):
+    staged = shlex.quote(staged.rstrip("/"))
+    partial = shlex.quote(results.rstrip("/") + ".partial")
+    results = shlex.quote(results.rstrip("/"))
+
+    return f"{{ mkdir -p $(dirname {results}) && rm -rf {partial} && cp -R {staged} {partial} && " \
+           f"rm -rf {results} && mv {partial} {results} && touch {shlex.quote(marker)} && " \
+           f"rm -rf {shlex.quote(stagedir)}; }}"
 
 # Unit-test
 if __name__ == "__main__":
@@ -4,15 +4,23 @@ job_manager.py
 Provides functions to handle starting and stopping jobs
 """
 from .job_instance import JobInstance
-from .job_config import JobConfig
-from .machine_access import MachineAccess
-from .table_display import display_table
+from .job_config import JobConfig, DEFAULT_HOST_TIMEOUT
+from .machine_access import get_access
+from .transfer import copy_between
+from .job_environment import prepare_env
+from .core_allocation import CoreTopology
+from .machine_status import MemInfo, get_cached_status, cache_status
+from .machine_groups import fan_out, report_errors
+from .table_display import display_table, is_machine_readable
+from . import tracing
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import sys, os
 import time
+import shlex
 import yaml
 
-def job_start(machines, jm, machine_name, jobfile, args):
+def job_start(machines, jm, machine_name, jobfile, args, attempt=1, resume_from=None, queue=False):
     print(f"Loading job from file {jobfile}")
     jid = jm.get_next_jid()
 
@@ -33,66 +41,371 @@ def job_start(machines, jm, machine_name, jobfile, args):
 
     job_inst = JobInstance(job_config, machine, jid, args)
 
-    with MachineAccess(machine) as m:
-        assert m.run_to_end("mkdir -p "+job_inst.get_jobdir())[1] == 0, "Failed to create working directory"
-        assert m.run_to_end("mkdir -p "+job_inst.get_tmpdir())[1] == 0, "Failed to create temp directory"
-        assert m.run_to_end("mkdir -p "+job_inst.get_data_dir())[1] == 0, "Failed to create src directory"
+    # the cores reserved for the job are released if it fails to start,
+    # and otherwise are held by the job once it has been added
+    try:
+        with tracing.span("job_start", machine_name, jid=jid), get_access(machine) as m:
+            if job_config.cores is not None:
+                topo, job_inst.cores = _reserve_cores(m, jm, jid, machine_name, job_config.cores, queue)
+                if topo.has_taskset:
+                    job_inst.cpus = topo.cpu_list(job_inst.cores)
+                print(f"Reserved cores {', '.join(str(x) for x in job_inst.cores)} "
+                      f"({'CPUs ' + job_inst.cpus if job_inst.cpus else 'not pinned, taskset is unavailable'})")
+
+            if job_inst.uses_machine_vars():
+                job_inst.machine_vars = _machine_vars(m, machine, job_inst)
+
+            with tracing.span("create_dirs", machine_name):
+                assert m.run_to_end("mkdir -p "+job_inst.get_jobdir())[1] == 0, "Failed to create working directory"
+                assert m.run_to_end("mkdir -p "+job_inst.get_tmpdir())[1] == 0, "Failed to create temp directory"
+                assert m.run_to_end("mkdir -p "+job_inst.get_data_dir())[1] == 0, "Failed to create src directory"
+                if job_config.staging:
+                    assert m.run_to_end("mkdir -p "+job_inst.get_stagedir())[1] == 0, "Failed to create staging directory"
+
+            m.push_dir(jobdir, job_inst.get_data_dir())
+
+            if job_config.environment is not None:
+                job_inst.env_dir = prepare_env(m, machine, job_config.environment, jobdir)
+
+            if resume_from is not None and job_config.retry and job_config.retry.checkpoint:
+                _restore_checkpoint(machines, resume_from, job_inst)
+
+            dirname = jobdir
+            while dirname.endswith("/"): dirname = dirname[:-1]
+            dirname = dirname.split("/")[-1]
+
+            cmd = job_inst.get_entry_cmd()
+            print(f"Starting with command: {cmd}")
+
+            data_dir = os.path.join(job_inst.get_data_dir(), dirname)
+
+            pid = m.execute_with_nohup(job_inst.get_wrapped_cmd(), data_dir)
+            print(f"Job started with job ID {jid} and PID {pid}")
+
+        jm.add(jid, job_config.name, machine_name,
+               data_dir, job_inst.get_results_dir(), cmd, pid, time.time(),
+               job_inst.get_status_file(), os.path.abspath(jobfile), args,
+               attempt, resume_from["id"] if resume_from else None,
+               job_config.logging is not None,
+               job_inst.get_sync_cmd() if job_config.staging else None,
+               job_inst.cores, pid,
+               job_inst.get_staged_results_dir() if job_config.staging else None)
+    finally:
+        jm.release(jid)
 
-        m.push_dir(jobdir, job_inst.get_data_dir())
-        dirname = jobdir
-        while dirname.endswith("/"): dirname = dirname[:-1]
-        dirname = dirname.split("/")[-1]
+    return jid
 
-        cmd = job_inst.get_entry_cmd()
-        print(f"Starting with command: {cmd}")
+# The machine's specs for filling in job templates, from the cached status
+# if there is one. Jobs with reserved cores see only their own cores.
+def _machine_vars(m, machine, job_inst):
+    cached = get_cached_status(machine.name)
+
+    if cached is None:
+        topo = CoreTopology.populate(m)
+        mem = MemInfo.populate(m, machine)
+        cached = {"cores": len(topo.cores), "threads": sum(len(x) for x in topo.cores), "mem_gb": mem.mem_total}
+        cache_status(machine.name, cached["cores"], cached["threads"], cached["mem_gb"])
+
+    out = {"cores": cached["cores"], "threads": cached["threads"], "mem_gb": cached["mem_gb"]}
+
+    if job_inst.cores is not None:
+        out["cores"] = len(job_inst.cores)
+        out["threads"] = len(job_inst.cpus.split(",")) if job_inst.cpus else len(job_inst.cores)
+
+    return out
+
+# Reserves physical cores on the machine for a job, returning the machine's
+# topology and the reserved cores. Fails if there are not enough free
+# cores, or with `queue`, waits until enough jobs have finished. The cores
+# are recorded as soon as they are chosen, under the job state's lock, so
+# jobs being started at the same time by other invocations of tinymon
+# can't choose the same ones.
+def _reserve_cores(m, jm, jid, machine_name, count, queue=False, poll_interval=10):
+    topo = CoreTopology.populate(m)
+    assert count <= len(topo.cores), f"Job needs {count} cores, but machine {machine_name} only has {len(topo.cores)}"
+
+    waiting = False
+    while True:
+        _refresh_reservations(m, jm, machine_name)
+
+        with jm.locked():
+            reserved = jm.reserved_cores(machine_name)
+            cores = topo.allocate(count, reserved)
+            if cores is not None:
+                jm.reserve(jid, machine_name, cores)
+                return topo, cores
+
+        free = len(topo.cores) - len(reserved)
+        assert queue, f"Machine {machine_name} has {free} of {len(topo.cores)} cores free, but the job needs {count} " \
+                      f"(use --queue to wait for them)"
+
+        if not waiting:
+            print(f"Waiting for {count} cores on machine {machine_name} ({free} of {len(topo.cores)} free)")
+            waiting = True
+
+        time.sleep(poll_interval)
+
+# Marks any jobs holding cores on the machine which have since finished as
+# completed, so their cores can be reused
+def _refresh_reservations(m, jm, machine_name):
+    states = [job for job in jm.list().values()
+              if job["active"] and job["machine"] == machine_name and job.get("cores")]
+    if len(states) == 0:
+        return
+
+    for jid, (status, exit_code, end_time) in probe_jobs(m, states).items():
+        if status == "done":
+            jm.set_stale(jid, exit_code, end_time)
+        elif status == "lost":
+            job_lost(jm, jid)
+
+# Copies the checkpoint of a lost job into the results dir of its relaunch.
+# Unless a staged job's results were synced, the checkpoint is still in its
+# staging directory. If it cannot be reached (i.e. it was on the lost
+# machine's local disk), the job starts over.
+def _restore_checkpoint(machines, old_state, job_inst):
+    ckpt = job_inst.config.retry.checkpoint
+    results_dir = old_state["results_dir"]
+    if old_state.get("staged_results_dir") and not old_state.get("synced"):
+        results_dir = old_state["staged_results_dir"]
+
+    src_dir = os.path.join(results_dir, os.path.dirname(ckpt))
+    dst_dir = os.path.join(job_inst.get_staged_results_dir(), os.path.dirname(ckpt))
+
+    ok, out = copy_between(machines[old_state["machine"]], src_dir, os.path.basename(ckpt),
+                           job_inst.machine, dst_dir)
+
+    if ok:
+        print(f"Resuming from checkpoint of job ID {old_state['id']}")
+    else:
+        print(f"Could not retrieve checkpoint of job ID {old_state['id']}, starting over")
 
-        data_dir = os.path.join(job_inst.get_data_dir(), dirname)
+def _retry_policy(state):
+    if not state.get("jobfile"):
+        return None
 
-        pid = m.execute_with_nohup(cmd, data_dir)
-        print(f"Job started with job ID {jid} and PID {pid}")
+    try:
+        return JobConfig.parsefile(state["jobfile"]).retry
+    except Exception as e:
+        print(f"Failed to load retry policy for job ID {state['id']}: {e}")
+        return None
 
-    jm.add(jid, job_config.name, machine_name,
-           data_dir, job_inst.get_results_dir(), cmd, pid, time.time())
+# Follows a job through any relaunches to its most recent attempt
+def final_jid(jm, jid):
+    while jm.get(jid) is not None and jm.get(jid).get("requeued_as"):
+        jid = jm.get(jid)["requeued_as"]
 
     return jid
 
+# Marks a job as lost along with its process or machine, and schedules it to
+# be relaunched if its retry policy allows. Returns whether it will be.
+def job_lost(jm, jid):
+    state = jm.get(jid)
+    jm.set_stale(jid)
+
+    policy = _retry_policy(state)
+    attempt = state.get("attempt", 1)
+    if policy is None or attempt >= policy.max_attempts:
+        return False
+
+    delay = policy.backoff * 2 ** (attempt - 1)
+    jm.update(jid, requeue_at=time.time() + delay)
+    print(f"Job ID {jid} will be relaunched in {round(delay)}s (attempt {attempt+1} of {policy.max_attempts})")
+    return True
+
+# Records that a job's machine could not be reached, returning True once it
+# has been unreachable for longer than the job's retry policy allows (or
+# DEFAULT_HOST_TIMEOUT for jobs without one)
+def _note_unreachable(jm, jid):
+    if jm.get(jid).get("unreachable_since") is None:
+        jm.update(jid, unreachable_since=time.time())
+
+    state = jm.get(jid)
+    policy = _retry_policy(state)
+    host_timeout = policy.host_timeout if policy is not None else DEFAULT_HOST_TIMEOUT
+    return time.time() - state["unreachable_since"] > host_timeout
+
+def _note_reachable(jm, jid):
+    if jm.get(jid).get("unreachable_since") is not None:
+        jm.update(jid, unreachable_since=None)
+
+# Picks the least-loaded machine which can currently be logged into,
+# preferring machines other than the one the job was lost on
+def _pick_machine(machines, jm, candidates, lost_on):
+    load = {name: 0 for name in candidates}
+    for job in jm.list().values():
+        if job["active"] and job["machine"] in load:
+            load[job["machine"]] += 1
+
+    for name in sorted(candidates, key=lambda x: (x == lost_on, load[x])):
+        try:
+            with get_access(machines[name], skip_unhealthy=True) as m:
+                m.execute_cmd("true")
+
+            return name
+
+        except Exception:
+            print(f"Machine {name} is unreachable")
+
+    return None
+
+# Relaunches all lost jobs whose backoff has elapsed
+def requeue_pending(machines, jm):
+    for jid, state in list(jm.list().items()):
+        if state.get("requeue_at") is None or state.get("requeued_as"): continue
+        if state["requeue_at"] > time.time(): continue
+
+        policy = _retry_policy(state)
+        if policy is None:
+            jm.update(jid, requeue_at=None)
+            continue
+
+        candidates = [x for x in (policy.machines or list(machines)) if x in machines]
+        machine = _pick_machine(machines, jm, candidates, state["machine"])
+
+        if machine is None:
+            print(f"No machines are available to relaunch job ID {jid}, will try again later")
+            jm.update(jid, requeue_at=time.time() + policy.backoff)
+            continue
+
+        print(f"Relaunching job ID {jid} on machine {machine}")
+        try:
+            new_jid = job_start(machines, jm, machine, state["jobfile"], state["args"] or {},
+                                state.get("attempt", 1) + 1, state)
+        except AssertionError as e:
+            # i.e. the machine does not have enough free cores
+            print(f"Failed to relaunch job ID {jid}: {e}, will try again later")
+            jm.update(jid, requeue_at=time.time() + policy.backoff)
+            continue
+
+        jm.update(jid, requeued_as=new_jid)
+
+# Starts the same job on each of the given machines concurrently
+def job_start_many(machines, jm, machine_names, jobfile, args, queue=False):
+    results = fan_out(machine_names, lambda name: job_start(machines, jm, name, jobfile, args, queue=queue))
+
+    rows = [[name, str(jid)] for name, (jid, err) in results.items() if err is None]
+    if len(rows) > 0:
+        display_table("Started Jobs", ["Machine", "Job ID"], rows)
+
+    report_errors("Failed to Start", results)
+    return results
+
 def job_kill(machines, jid, jm):
     state = jm.get(jid)
     assert state is not None, f"Job ID {jid} doesn't exist"
     assert state["active"], f"Job ID {jid} has completed already"
 
     machine = machines[state["machine"]]
-    pid = int(state["pid"])
 
-    with MachineAccess(machine) as m:
-        assert m.run_to_end(f"kill -9 {pid}")[1] == 0, "Failed to kill the process"
+    with get_access(machine) as m:
+        assert m.run_to_end(_kill_cmd(state))[1] == 0, "Failed to kill the process"
 
     print(f"Successfully killed job ID {jid} of job {state['name']} on machine {state['machine']}")
     jm.remove(jid)
 
-def job_log(machines, jid, jm):
+# Jobs run in their own process group, so the wrapper shells, the job, and
+# anything it started are all killed together
+def _kill_cmd(state):
+    if state.get("pgid"):
+        return f"kill -9 -{int(state['pgid'])}"
+
+    # jobs started before they had their own process group
+    return f"kill -9 {int(state['pid'])}"
+
+# A command which outputs a job's stdout or stderr log
+def log_cmd(state, stream="stdout"):
+    data_dir = shlex.quote(state["data_dir"])
+
+    if state.get("logging"):
+        # rotated logs are concatenated oldest-first, decompressing as needed
+        return f"(cd {data_dir} && for f in $(ls -1 {stream}.log.* 2>/dev/null); do " \
+               f"case $f in *.gz) gzip -dc $f 2>/dev/null;; *) cat $f;; esac; done)"
+
+    assert stream == "stdout", f"Job ID {state['id']} does not capture stderr separately"
+    return f"cat {data_dir}/nohup.out"
+
+# Reads a job's stdout or stderr log. If a pattern is given, the log is
+# filtered on the remote machine so only the matching lines are transferred.
+def read_log(m, state, stream="stdout", pattern=None):
+    if not state.get("logging") and pattern is None:
+        assert stream == "stdout", f"Job ID {state['id']} does not capture stderr separately"
+
+        m.pull_file(os.path.join(state["data_dir"], "nohup.out"), "/tmp/_nohup.out")
+        with open("/tmp/_nohup.out") as f:
+            return f.read()
+
+    cmd = log_cmd(state, stream)
+
+    if pattern is not None:
+        cmd = f"{{ {cmd}; }} | grep -E -- {shlex.quote(pattern)}"
+
+    out, _ = m.run_to_end(cmd)
+    if not isinstance(out, str): out = out.decode(errors="replace")
+    return out
+
+# Kills many jobs, with a single command for each machine and all
+# machines in parallel
+def job_kill_many(machines, jids, jm):
+    by_machine = {}
+    for jid in jids:
+        state = jm.get(jid)
+        assert state is not None, f"Job ID {jid} doesn't exist"
+        assert state["active"], f"Job ID {jid} has completed already"
+        by_machine.setdefault(state["machine"], []).append(jid)
+
+    def kill(name):
+        cmd = "; ".join(f"{_kill_cmd(jm.get(jid))} && echo {jid}" for jid in by_machine[name])
+
+        with get_access(machines[name]) as m:
+            out, _ = m.run_to_end(cmd)
+
+        if not isinstance(out, str): out = out.decode()
+        killed = [int(x) for x in out.split() if x.isdigit()]
+        for jid in killed:
+            jm.remove(jid)
+
+        failed = [jid for jid in by_machine[name] if jid not in killed]
+        assert len(failed) == 0, f"Failed to kill job IDs {', '.join(str(x) for x in failed)}"
+        return killed
+
+    results = fan_out(list(by_machine), kill)
+
+    killed = sum((x for x, _ in results.values() if x), [])
+    print(f"Successfully killed {len(killed)} jobs")
+    report_errors("Failed to Kill", results)
+    return results
+
+def job_log(machines, jid, jm, stream="stdout", pattern=None):
     state = jm.get(jid)
     assert state is not None, f"Job ID {jid} doesn't exist"
 
-    print(f"Retrieving logs for job ID {jid}")
+    print(f"Retrieving {stream} logs for job ID {jid}")
     print()
     print("="*80)
 
     machine = machines[state["machine"]]
     pid = int(state["pid"])
 
-    with MachineAccess(machine) as m:
-        print(os.path.join(state["data_dir"], "nohup.out"))
-        m.pull_file(os.path.join(state["data_dir"], "nohup.out"), "/tmp/_nohup.out")
-
-    with open("/tmp/_nohup.out") as f:
-        print(f.read())
+    with get_access(machine) as m:
+        log = read_log(m, state, stream, pattern)
 
+    print(log)
     print("="*80)
 
 def job_check(machines, jid, jm):
+    assert jm.get(jid) is not None, f"Job ID {jid} doesn't exist"
+
+    requeue_pending(machines, jm)
+    if final_jid(jm, jid) != jid:
+        print(f"Job ID {jid} was relaunched as job ID {final_jid(jm, jid)}")
+        jid = final_jid(jm, jid)
+
     state = jm.get(jid)
-    assert state is not None, f"Job ID {jid} doesn't exist"
+    if state.get("requeue_at"):
+        print(f"Job ID {jid} is waiting to be relaunched")
+        return True
+
     assert state["active"], f"Job ID {jid} has completed already"
 
     print(f"Checking status of job ID {jid}")
@@ -100,47 +413,340 @@ def job_check(machines, jid, jm):
     machine = machines[state["machine"]]
     pid = int(state["pid"])
 
-    with MachineAccess(machine) as m:
-        is_running = (m.run_to_end(f"ps -p {pid}")[1] == 0)
+    try:
+        with get_access(machine) as m:
+            status, exit_code, end_time = probe_jobs(m, [state])[jid]
+            is_running = (status == "running")
+
+            if not is_running:
+                log = read_log(m, state)
+
+    except Exception as e:
+        print(f"Failed to reach machine {state['machine']}: {e}")
+        if _note_unreachable(jm, jid):
+            print(f"Job ID {jid} has been lost along with machine {state['machine']}")
+            if not job_lost(jm, jid):
+                return False
+
+            requeue_pending(machines, jm)
 
-        if not is_running:
-            m.pull_file(os.path.join(state["data_dir"], "nohup.out"), "/tmp/_nohup.out")
+        return True
+
+    _note_reachable(jm, jid)
 
     if is_running:
         print(f"Job ID {jid} is running")
     else:
         print("="*80)
-        with open("/tmp/_nohup.out") as f:
-            print(f.read())
+        print(log)
         print("="*80)
 
-        print(f"Job ID {jid} has completed")
+        print(_describe_completion(jid, status, exit_code))
+
+        if status == "lost":
+            if job_lost(jm, jid):
+                requeue_pending(machines, jm)
+                return True
 
-        if state["results_dir"] is not None:
+        elif state["results_dir"] is not None:
             print(f"Use the 'retrieve' command to pull the results of the job")
 
-        jm.set_stale(jid)
+        jm.set_stale(jid, exit_code, end_time)
 
     return is_running
 
+# Checks the status of many jobs, probing each machine once and all
+# machines in parallel, and displays them as a table
+def job_status_many(machines, jids, jm):
+    requeue_pending(machines, jm)
+
+    by_machine = {}
+    rows = []
+    for jid in jids:
+        assert jm.get(jid) is not None, f"Job ID {jid} doesn't exist"
+        jid = final_jid(jm, jid)
+        state = jm.get(jid)
+
+        if state.get("requeue_at"):
+            rows.append([str(jid), state["name"], state["machine"], "Waiting to relaunch"])
+        elif not state["active"]:
+            rows.append([str(jid), state["name"], state["machine"], _describe_exit(state)])
+        else:
+            by_machine.setdefault(state["machine"], []).append(jid)
+
+    def probe(name):
+        with get_access(machines[name], skip_unhealthy=True) as m:
+            return probe_jobs(m, [jm.get(jid) for jid in by_machine[name]])
+
+    results = fan_out(list(by_machine), probe)
+
+    for name, (res, err) in results.items():
+        for jid in by_machine[name]:
+            state = jm.get(jid)
+
+            if err is not None:
+                if not _note_unreachable(jm, jid):
+                    rows.append([str(jid), state["name"], name, "Unreachable"])
+                elif job_lost(jm, jid):
+                    rows.append([str(jid), state["name"], name, "Lost, will relaunch"])
+                else:
+                    rows.append([str(jid), state["name"], name, _describe_exit(jm.get(jid))])
+                continue
+
+            _note_reachable(jm, jid)
+            status, exit_code, end_time = res[jid]
+
+            if status == "running":
+                rows.append([str(jid), state["name"], name, "Running"])
+            elif status == "lost" and job_lost(jm, jid):
+                rows.append([str(jid), state["name"], name, "Lost, will relaunch"])
+            else:
+                if status != "lost":
+                    jm.set_stale(jid, exit_code, end_time)
+                rows.append([str(jid), state["name"], name, _describe_exit(state)])
+
+    display_table("Job Statuses", ["Job ID", "Name", "Machine", "Status"],
+                  sorted(rows, key=lambda x: int(x[0])))
+    report_errors("Unreachable Machines", results)
+
+def _describe_exit(state):
+    if state.get("exit_code") is not None:
+        return f"Exited ({state['exit_code']})"
+
+    return "Lost" if state.get("status_file") else "Completed"
+
+# Checks the status of several jobs on the same machine with a single
+# command. Returns {jid: (status, exit code, end time)}, where status is
+# "running", "done", or "lost" if the job ended without recording its
+# exit status (i.e. it was killed or the machine restarted)
+def probe_jobs(m, states):
+    checks = []
+    for state in states:
+        jid, pid = state["id"], int(state["pid"])
+
+        # jobs started before exit statuses were recorded
+        if not state.get("status_file"):
+            checks.append(f"if ps -p {pid} > /dev/null; then echo {jid} running; else echo {jid} done; fi")
+            continue
+
+        # the status file is checked first, so a reused PID is not
+        # mistaken for the job, and again after ps in case it just ended
+        f = shlex.quote(state["status_file"])
+        checks.append(f"if [ -f {f} ]; then echo {jid} done $(cat {f}); "
+                      f"elif ps -p {pid} > /dev/null; then echo {jid} running; "
+                      f"elif [ -f {f} ]; then echo {jid} done $(cat {f}); "
+                      f"else echo {jid} lost; fi")
+
+    out, _ = m.run_to_end("; ".join(checks))
+    if not isinstance(out, str): out = out.decode()
+
+    results = {}
+    for line in out.splitlines():
+        fields = line.split()
+        if len(fields) < 2 or not fields[0].isdigit(): continue
+
+        exit_code = int(fields[2]) if len(fields) > 2 else None
+        end_time = int(fields[3]) if len(fields) > 3 else None
+        results[int(fields[0])] = (fields[1], exit_code, end_time)
+
+    for state in states:
+        assert state["id"] in results, f"Failed to check status of job ID {state['id']}"
+
+    return results
+
+def _describe_completion(jid, status, exit_code):
+    if status == "lost":
+        return f"Job ID {jid} has stopped without recording an exit code (killed or machine restarted)"
+    if exit_code is None:
+        return f"Job ID {jid} has completed"
+
+    return f"Job ID {jid} has completed with exit code {exit_code}"
+
+# Whether a completed job exited unsuccessfully, or stopped without
+# recording its exit code
+def job_failed(state):
+    if state.get("exit_code") is None:
+        return bool(state.get("status_file"))
+
+    return state["exit_code"] != 0
+
+# Quietly checks whether a job is still running, marking it as
+# completed if it is not
+def job_poll(machines, jid, jm):
+    assert jm.get(jid) is not None, f"Job ID {jid} doesn't exist"
+
+    requeue_pending(machines, jm)
+    jid = final_jid(jm, jid)
+    state = jm.get(jid)
+
+    # lost, and waiting to be relaunched
+    if state.get("requeue_at"):
+        return True
+
+    if not state["active"]:
+        return False
+
+    try:
+        with get_access(machines[state["machine"]]) as m:
+            status, exit_code, end_time = probe_jobs(m, [state])[jid]
+
+    except Exception:
+        return job_lost(jm, jid) if _note_unreachable(jm, jid) else True
+
+    _note_reachable(jm, jid)
+
+    if status == "lost":
+        return job_lost(jm, jid)
+
+    if status != "running":
+        jm.set_stale(jid, exit_code, end_time)
+
+    return status == "running"
+
+# Blocks until all of the given jobs have completed, checking all jobs on
+# each machine with a single probe and backing off while nothing changes.
+# Returns the IDs of jobs which did not exit successfully.
+def job_wait(machines, jids, jm, min_interval=1, max_interval=60):
+    for jid in jids:
+        assert jm.get(jid) is not None, f"Job ID {jid} doesn't exist"
+
+    pending = {}
+    requeueing = set()
+
+    def track(jid):
+        state = jm.get(jid)
+        if state.get("requeue_at"):
+            requeueing.add(jid)
+        elif state["active"]:
+            pending.setdefault(state["machine"], []).append(jid)
+
+    for jid in jids:
+        track(final_jid(jm, jid))
+
+    print(f"Waiting for {sum(len(x) for x in pending.values()) + len(requeueing)} jobs on {len(pending)} machines")
+
+    # sessions are kept open across polls to avoid logging in every time
+    sessions = {}
+
+    def probe(name):
+        try:
+            if name not in sessions:
+                sessions[name] = get_access(machines[name], skip_unhealthy=True)
+                sessions[name].login()
+
+            return probe_jobs(sessions[name], [jm.get(jid) for jid in pending[name]])
+
+        except Exception as e:
+            print(f"Failed to check jobs on machine {name}: {e}")
+            if name in sessions:
+                sessions.pop(name).logout()
+
+            return None
+
+    interval = min_interval
+    try:
+        while len(pending) > 0 or len(requeueing) > 0:
+            changed = False
+
+            # pick up jobs which have been relaunched since the last poll
+            if len(requeueing) > 0:
+                requeue_pending(machines, jm)
+
+            for jid in list(requeueing):
+                if jm.get(jid).get("requeued_as"):
+                    requeueing.remove(jid)
+                    track(jm.get(jid)["requeued_as"])
+                    changed = True
+
+            with ThreadPoolExecutor(max_workers=max(len(pending), 1)) as ex:
+                results = dict(zip(list(pending), ex.map(probe, list(pending))))
+
+            for name, res in results.items():
+                if res is None:
+                    # jobs are only given up on once their machine has been
+                    # unreachable for longer than their retry policy allows
+                    lost = [jid for jid in pending[name] if _note_unreachable(jm, jid)]
+                    res = {jid: ("lost", None, None) for jid in lost}
+                else:
+                    for jid in res: _note_reachable(jm, jid)
+
+                for jid, (status, exit_code, end_time) in res.items():
+                    if status == "running": continue
+
+                    print(_describe_completion(jid, status, exit_code))
+                    if status == "lost" and job_lost(jm, jid):
+                        requeueing.add(jid)
+                    elif status != "lost":
+                        jm.set_stale(jid, exit_code, end_time)
+
+                    pending[name].remove(jid)
+                    changed = True
+
+                if len(pending[name]) == 0:
+                    del pending[name]
+
+            if len(pending) == 0 and len(requeueing) == 0: break
+
+            interval = min_interval if changed else min(interval * 1.5, max_interval)
+            time.sleep(interval)
+
+    finally:
+        for m in sessions.values():
+            m.logout()
+
+    failed = [jid for jid in jids if job_failed(jm.get(final_jid(jm, jid)))]
+
+    print(f"All jobs have completed, {len(failed)} failed")
+    return failed
+
 def job_retrieve(machines, jid, jm, outdir):
     state = jm.get(jid)
     assert state is not None, f"Job ID {jid} doesn't exist"
     assert not state["active"], f"Job ID {jid} is still running"
     assert state["results_dir"] is not None, f"Job ID {jid} does not have a results directory specified"
+    assert not state.get("collected"), f"Job ID {jid} has been removed from its machine by 'tinymon gc'"
 
     print(f"Retrieving results from job ID {jid}")
 
     machine = machines[state["machine"]]
     pid = int(state["pid"])
 
-    with MachineAccess(machine) as m:
+    with get_access(machine) as m:
+        if state.get("sync_cmd"):
+            assert _results_synced(m, state), \
+                    f"Results of job ID {jid} were not synced from its staging directory, try 'tinymon job sync {jid}'"
+
         m.pull_dir(state["results_dir"], outdir)
 
     print(f"Saved results to {outdir}")
 
+def _results_synced(m, state):
+    marker = os.path.join(os.path.dirname(state["status_file"]), "results_synced")
+    return m.run_to_end(f"test -f {shlex.quote(marker)}")[1] == 0
+
+# Copies the results of a staged job into its workdir, if they were not
+# already, i.e. because the machine went down before the job finished
+def job_sync(machines, jid, jm):
+    state = jm.get(jid)
+    assert state is not None, f"Job ID {jid} doesn't exist"
+    assert state.get("sync_cmd"), f"Job ID {jid} does not use staging"
+    assert not state["active"], f"Job ID {jid} is still running, its results will be synced when it completes"
+
+    with get_access(machines[state["machine"]]) as m:
+        if _results_synced(m, state):
+            jm.update(jid, synced=True)
+            print(f"Results of job ID {jid} have already been synced to {state['results_dir']}")
+            return
+
+        out, status = m.run_to_end(state["sync_cmd"])
+        if not isinstance(out, str): out = out.decode()
+        assert status == 0, f"Failed to sync results of job ID {jid}, its staging directory may have been lost: {out.strip()}"
+        jm.update(jid, synced=True)
+
+    print(f"Synced results of job ID {jid} to {state['results_dir']}")
+
 def job_list(jm):
-    col_names = ["Job ID", "Name", "Machine", "Running Time"]
+    col_names = ["Job ID", "Name", "Machine", "Cores", "Running Time"]
     rows = []
 
     for jid, job in jm.list().items():
@@ -159,10 +765,11 @@ def job_list(jm):
             str(jid),
             job["name"],
             job["machine"],
+            ",".join(str(x) for x in job["cores"]) if job.get("cores") else "",
             td
         ])
 
-    if len(rows) == 0:
+    if len(rows) == 0 and not is_machine_readable():
         print("No currently-running jobs")
     else:
         display_table("Running Job List", col_names, rows)
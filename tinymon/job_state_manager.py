@@ -1,54 +1,164 @@
 """
 job_state_manager.py
 
-JobStateManager tracks all running and completed jobs
+JobStateManager tracks all running and completed jobs. Updates are
+serialized with a lock, so it can be shared by threads operating on
+many machines at once. As other invocations of tinymon update the same
+file, every update also holds a lock file and first re-reads the state if
+it has changed on disk, so that their changes (i.e. cores reserved by a
+job which is still starting) are never overwritten.
 """
-from .config import JOBMGR_YAML
+from .config import JOBMGR_YAML, JOBMGR_LOCK
+from contextlib import contextmanager
+import fcntl
+import os
+import threading
 import yaml
 
 class JobStateManager:
     def __init__(self):
-        try:
-            with open(JOBMGR_YAML) as f:
-                self.data = yaml.load(f, yaml.Loader)
+        self.lock = threading.RLock()
+        self.lock_file = None
+        self.load()
 
-            self.jobs = self.data["jobs"]
-            self.idx = int(self.data["idx"])
+    def load(self):
+        with self.lock:
+            try:
+                with open(JOBMGR_YAML) as f:
+                    self.data = yaml.load(f, yaml.Loader)
 
-        except:
-            self.jobs = {}
-            self.idx = 1000
+                self.jobs = self.data["jobs"]
+                self.idx = int(self.data["idx"])
+                self.reservations = self.data.get("reservations") or {}
 
+            except:
+                self.jobs = {}
+                self.idx = 1000
+                self.reservations = {}
+
+            self.stamp = _stamp()
+
+    # Holds the lock file, with the state re-read from disk if it has
+    # changed, so that other invocations of tinymon can't make conflicting
+    # changes until it is released
+    @contextmanager
+    def locked(self):
+        with self.lock:
+            if self.lock_file is not None:
+                yield
+                return
+
+            with open(JOBMGR_LOCK, "a") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                self.lock_file = f
+                try:
+                    if _stamp() != self.stamp:
+                        self.load()
+                    yield
+                finally:
+                    self.lock_file = None
+
+    # Written to a temporary file first, so it is never read half-written
     def save(self):
-        self.data = {"jobs": self.jobs, "idx": self.idx}
+        with self.locked():
+            self.data = {"jobs": self.jobs, "idx": self.idx, "reservations": self.reservations}
 
-        with open(JOBMGR_YAML, "w+") as f:
-            yaml.dump(self.data, f, yaml.Dumper)
+            tmp = f"{JOBMGR_YAML}.{os.getpid()}.tmp"
+            with open(tmp, "w+") as f:
+                yaml.dump(self.data, f, yaml.Dumper)
+            os.replace(tmp, JOBMGR_YAML)
+            self.stamp = _stamp()
 
     def get_next_jid(self):
-        self.idx += 1
-        jid = self.idx
-        self.save()
-        return jid
-
-    def add(self, jid, name, machine, data_dir, results_dir, cmd, pid, start_time):
-        self.jobs[jid] = {"id": jid, "name": name, "machine": machine,
-                          "pid": pid, "start_cmd": cmd,
-                          "data_dir": data_dir, "results_dir": results_dir,
-                          "start_time": start_time, "active": True}
-        self.save()
-        return jid
-
-    def set_stale(self, jid):
-        self.jobs[jid]["active"] = False
-        self.save()
+        with self.locked():
+            self.idx += 1
+            jid = self.idx
+            self.save()
+            return jid
+
+    def add(self, jid, name, machine, data_dir, results_dir, cmd, pid, start_time,
+            status_file=None, jobfile=None, args=None, attempt=1, retry_of=None,
+            logging=False, sync_cmd=None, cores=None, pgid=None, staged_results_dir=None):
+        with self.locked():
+            self.jobs[jid] = {"id": jid, "name": name, "machine": machine,
+                              "pid": pid, "start_cmd": cmd,
+                              "data_dir": data_dir, "results_dir": results_dir,
+                              "status_file": status_file,
+                              "jobfile": jobfile, "args": args,
+                              "attempt": attempt, "retry_of": retry_of,
+                              "logging": logging, "sync_cmd": sync_cmd,
+                              "staged_results_dir": staged_results_dir,
+                              "cores": cores, "pgid": pgid,
+                              "start_time": start_time, "active": True}
+            self.reservations.pop(jid, None)
+            self.save()
+            return jid
+
+    # Holds cores on a machine for a job which is still starting, until it
+    # is added or the reservation is released. Reservations of invocations
+    # of tinymon which have since exited are ignored.
+    def reserve(self, jid, machine, cores):
+        with self.locked():
+            self.reservations[jid] = {"machine": machine, "cores": cores, "owner": os.getpid()}
+            self.save()
+
+    def release(self, jid):
+        with self.locked():
+            if self.reservations.pop(jid, None) is not None:
+                self.save()
+
+    # The cores held on a machine by running jobs and by jobs still starting
+    def reserved_cores(self, machine):
+        reserved = set()
+        for job in self.jobs.values():
+            if job["active"] and job["machine"] == machine and job.get("cores"):
+                reserved.update(job["cores"])
+
+        for r in self.reservations.values():
+            if r["machine"] == machine and _is_running(r["owner"]):
+                reserved.update(r["cores"])
+
+        return reserved
+
+    # exit_code is None if the job ended without recording its exit status
+    def set_stale(self, jid, exit_code=None, end_time=None):
+        with self.locked():
+            self.jobs[jid]["active"] = False
+            self.jobs[jid]["exit_code"] = exit_code
+            self.jobs[jid]["end_time"] = end_time
+            self.save()
+
+    def update(self, jid, **fields):
+        with self.locked():
+            self.jobs[jid].update(fields)
+            self.save()
 
     def remove(self, jid):
-        del self.jobs[jid]
-        self.save()
+        with self.locked():
+            del self.jobs[jid]
+            self.save()
 
     def get(self, jid):
         return self.jobs.get(jid, None)
 
     def list(self):
         return self.jobs
+
+# Identifies the version of the state file on disk
+def _stamp():
+    try:
+        st = os.stat(JOBMGR_YAML)
+    except FileNotFoundError:
+        return None
+
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
@@ -0,0 +1,113 @@
+"""
+local_access.py
+
+Provides LocalMachineAccess, a drop-in replacement for MachineAccess which
+runs commands directly on the local host using subprocess and copies files
+using the local filesystem, instead of going through SSH.
+
+LocalMachineAccess also implements context-manager, so it can be used
+interchangeably with MachineAccess.
+"""
+import subprocess
+import os
+import sys
+import shutil
+from .machine_config import CopyMode
+from . import tracing
+
+class LocalMachineAccess:
+    def __init__(self, cfg):
+        self.cfg = cfg
+
+    def login(self):
+        pass
+
+    def execute_cmd(self, cmd, timeout=5):
+        try:
+            with tracing.span("execute_cmd", self.cfg.name, cmd=cmd):
+                p = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            assert False, f"Command '{cmd}' on machine '{self.cfg.name}' timed out"
+
+        assert p.returncode == 0, f"Command '{cmd}' on machine '{self.cfg.name}' failed with error code {p.returncode}"
+
+        return p.stdout.decode()
+
+    def execute_with_nohup(self, cmd, cwd):
+        # the job is started in the background of an intermediate shell, so it
+        # is adopted by init rather than left as an unreaped child of tinymon,
+        # and in its own session, so its PID is also its process group ID
+        with tracing.span("execute_with_nohup", self.cfg.name, cmd=cmd):
+            p = subprocess.run(["sh", "-c", 'setsid sh -c "$0" > nohup.out < /dev/null & echo $!', cmd],
+                               cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                               start_new_session=True)
+
+        return int(p.stdout.decode().strip())
+
+    def run_to_end(self, cmd):
+        with tracing.span("run_to_end", self.cfg.name, cmd=cmd):
+            p = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+        return p.stdout, p.returncode
+
+    def pull_file(self, remote, local):
+        with tracing.span("pull_file", self.cfg.name, path=remote) as s:
+            shutil.copyfile(remote, local)
+            s["bytes"] = os.path.getsize(local)
+
+    # Matches the layout produced by MachineAccess.pull_dir, where the
+    # remote directory ends up as a subdirectory of the local one
+    def pull_dir(self, remote, local):
+        local = os.path.expanduser(local)
+        with tracing.span("pull_dir", self.cfg.name, path=remote):
+            self._copy_dir(remote, os.path.join(local, os.path.basename(remote.rstrip("/"))), CopyMode.COPY)
+
+    def push_file(self, local, remote):
+        with tracing.span("push_file", self.cfg.name, path=remote) as s:
+            shutil.copyfile(local, remote)
+            s["bytes"] = os.path.getsize(local)
+
+    def push_dir(self, local, remote):
+        local = os.path.expanduser(local)
+        basename = os.path.basename(local)
+
+        if not os.path.isdir(local):
+            print("%r is not a directory" % local)
+            sys.exit(1)
+
+        with tracing.span("push_dir", self.cfg.name, path=remote):
+            self._copy_dir(local, os.path.join(remote, basename), self.cfg.copy_mode)
+
+    def _copy_dir(self, src, dst, mode):
+        if mode == CopyMode.REFLINK:
+            # cp falls back to a regular copy if the filesystem can't reflink
+            os.makedirs(dst, exist_ok=True)
+            p = subprocess.run(["cp", "-R", "--reflink=auto", os.path.join(src, "."), dst])
+            assert p.returncode == 0, f"Failed to copy {src} to {dst}"
+
+        elif mode == CopyMode.HARDLINK:
+            shutil.copytree(src, dst, copy_function=os.link, dirs_exist_ok=True)
+
+        else:
+            shutil.copytree(src, dst, dirs_exist_ok=True)
+
+    def logout(self):
+        pass
+
+    def __enter__(self):
+        self.login()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.logout()
+
+if __name__ == "__main__":
+    from .machine_config import MachineConfig
+
+    machine = MachineConfig.parseconfig("local", {"type": "local", "tmpdir": "/tmp", "workdir": "/tmp"}, {})
+
+    with LocalMachineAccess(machine) as m:
+        print(repr(m.execute_cmd("ls -1")))
+        print(repr(m.execute_cmd("pwd")))
+        print(repr(m.execute_cmd("hostname")))
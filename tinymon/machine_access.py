@@ -9,72 +9,161 @@ MachineAccess also implements context-manager, which can assist in cleanup
 when using it in error-prone situations.
 """
 import subprocess
-from .machine_config import MachineConfig
+from .machine_config import MachineConfig, MachineType
+from .local_access import LocalMachineAccess
+from .machine_health import get_health, HostUnavailable
+from . import tracing
 from .machine_credentials import MachineAuthMode
+import shlex
+import threading
 import time
 import tarfile
 import tempfile
 from pwn import *
 context.log_level = "error"
 
+# Names upload tarballs so that any left behind (i.e. by an interrupted
+# upload) can be told apart from other programs' temporary files
+UPLOAD_TARBALL_PREFIX = "tinymon-upload-"
+
 class MachineAccess:
-    def __init__(self, cfg):
+    # With skip_unhealthy, machines which have recently failed repeatedly
+    # are not tried at all, and raise HostUnavailable instead
+    def __init__(self, cfg, skip_unhealthy=False):
         self.cfg = cfg
         self.sess = None
+        self.skip_unhealthy = skip_unhealthy
 
     def login(self):
         if self.sess:
             return
 
-        if self.cfg.creds.authmode == MachineAuthMode.PASSWORD:
-            self.sess = ssh(host=self.cfg.host, user=self.cfg.creds.username, password=self.cfg.creds.password)
-        else:
-            self.sess = ssh(host=self.cfg.host, user=self.cfg.creds.username, keyfile=self.cfg.creds.sshkey)
+        health = get_health()
+        if self.skip_unhealthy:
+            reason = health.skip_reason(self.cfg.name)
+            if reason is not None:
+                raise HostUnavailable(reason)
+
+        start = time.time()
+        try:
+            with tracing.span("login", self.cfg.name):
+                self.sess = self._connect()
+        except Exception as e:
+            health.record_failure(self.cfg.name, e)
+            raise
+
+        health.record_success(self.cfg.name, time.time() - start)
+
+    # pwntools only bounds the TCP connection, so the whole login is run on
+    # a separate thread to also bound the SSH handshake and authentication.
+    # If the login times out but the thread connects later anyway, it closes
+    # the session itself rather than leaving it open.
+    def _connect(self):
+        result = {}
+        lock = threading.Lock()
+
+        def connect():
+            try:
+                if self.cfg.creds.authmode == MachineAuthMode.PASSWORD:
+                    sess = ssh(host=self.cfg.host, user=self.cfg.creds.username, password=self.cfg.creds.password,
+                               timeout=self.cfg.connect_timeout)
+                else:
+                    sess = ssh(host=self.cfg.host, user=self.cfg.creds.username, keyfile=self.cfg.creds.sshkey,
+                               timeout=self.cfg.connect_timeout)
+            except Exception as e:
+                result["error"] = e
+                return
+
+            with lock:
+                if not result.get("abandoned"):
+                    result["sess"] = sess
+                    return
+
+            sess.close()
+
+        t = threading.Thread(target=connect, daemon=True)
+        t.start()
+        t.join(self.cfg.connect_timeout + self.cfg.auth_timeout)
+
+        with lock:
+            if "sess" not in result and "error" not in result:
+                result["abandoned"] = True
+                raise TimeoutError(f"Login to machine '{self.cfg.name}' timed out")
+
+        if "error" in result:
+            raise result["error"]
+
+        return result["sess"]
 
     def execute_cmd(self, cmd, timeout=5):
         assert self.sess, "SSH must be connected to execute commands"
 
-        p = self.sess.process(cmd, shell=True)
+        with tracing.span("execute_cmd", self.cfg.name, cmd=cmd) as s:
+            p = self.sess.process(cmd, shell=True)
 
-        start = time.time()
-        while time.time() - start < timeout:
-            if p.poll() is not None: break
+            start = time.time()
+            while time.time() - start < timeout:
+                if p.poll() is not None: break
 
-        if p.poll() is None:
-            p.kill()
-            p.close()
+            if p.poll() is None:
+                p.kill()
+                p.close()
 
-        assert p.poll() is not None, f"Command '{cmd}' on machine '{self.cfg.name}' timed out"
-        assert p.poll() == 0, f"Command '{cmd}' on machine '{self.cfg.name}' failed with error code {p.poll()}"
+            assert p.poll() is not None, f"Command '{cmd}' on machine '{self.cfg.name}' timed out"
+            assert p.poll() == 0, f"Command '{cmd}' on machine '{self.cfg.name}' failed with error code {p.poll()}"
 
-        return p.recvall().decode()
+            out = p.recvall()
+            s["bytes"] = len(out)
 
+        return out.decode()
+
+    # The job is started in the background in its own session, detached from
+    # the SSH connection, so its PID is also its process group ID and the
+    # whole job (including any processes it starts) can be killed at once
     def execute_with_nohup(self, cmd, cwd):
-        # no neeed for nohup, handled it with pwntools python backend
-        p = self.sess.process(["sh", "-c", "cd {cwd}; " + cmd + " > nohup.out"], cwd=cwd)
+        launch = f"cd {shlex.quote(cwd)} || exit 1; " \
+                 f"setsid sh -c {shlex.quote(cmd)} > nohup.out 2>/dev/null < /dev/null & echo $!"
+
+        with tracing.span("execute_with_nohup", self.cfg.name, cmd=cmd):
+            out, status = self.sess.run_to_end(launch)
+
+        if not isinstance(out, str): out = out.decode()
+        assert status == 0 and out.strip().isdigit(), f"Failed to start the job: {out.strip()}"
 
         # let the process start before disconnecting
-        time.sleep(10)
-        return p.pid
+        with tracing.span("launch_wait", self.cfg.name):
+            time.sleep(10)
+
+        return int(out.strip())
 
     def run_to_end(self, cmd):
-        return self.sess.run_to_end(cmd)
+        with tracing.span("run_to_end", self.cfg.name, cmd=cmd):
+            return self.sess.run_to_end(cmd)
 
     def pull_file(self, remote, local):
         assert self.sess, "SSH must be connected to pull files"
-        self.sess.download_file(remote, local)
+        with tracing.span("pull_file", self.cfg.name, path=remote) as s:
+            self.sess.download_file(remote, local)
+            s["bytes"] = os.path.getsize(local)
 
     def pull_dir(self, remote, local):
         assert self.sess, "SSH must be connected to pull files"
-        self.sess.download_dir(remote, local)
+        with tracing.span("pull_dir", self.cfg.name, path=remote) as s:
+            # files already in the local directory were not transferred
+            before = _dir_size(local)
+            self.sess.download_dir(remote, local)
+            s["bytes"] = max(_dir_size(local) - before, 0)
 
     def push_file(self, local, remote):
         assert self.sess, "SSH must be connected to push files"
-        self.sess.upload_file(local, remote)
+        with tracing.span("push_file", self.cfg.name, path=remote) as s:
+            self.sess.upload_file(local, remote)
+            s["bytes"] = os.path.getsize(local)
 
     def push_dir(self, local, remote):
         assert self.sess, "SSH must be connected to push files"
-        self._upload_dir(local, remote)
+        with tracing.span("push_dir", self.cfg.name, path=remote):
+            self._upload_dir(local, remote)
 
     # https://github.com/arthaud/python3-pwntools/blob/7519197918/pwnlib/tubes/ssh.py
     def _upload_dir(self, local, remote):
@@ -88,20 +177,33 @@ class MachineAccess:
         msg = "Uploading %r to %r" % (basename, remote)
         with self.sess.waitfor(msg) as w:
             # Generate a tarfile with everything inside of it
-            local_tar = tempfile.mktemp()
-            with tarfile.open(local_tar, 'w:gz') as tar:
-                tar.add(local, basename)
+            with tracing.span("build_tarball", self.cfg.name) as s:
+                local_tar = tempfile.mktemp(prefix=UPLOAD_TARBALL_PREFIX, suffix=".tar.gz")
+                with tarfile.open(local_tar, 'w:gz') as tar:
+                    tar.add(local, basename)
+                s["bytes"] = os.path.getsize(local_tar)
 
             # Upload and extract it
             with context.local(log_level='error'):
-                remote_tar = self.sess.mktemp('--suffix=.tar.gz')
+                remote_tar, status = self.sess.run_to_end(f"mktemp --tmpdir {UPLOAD_TARBALL_PREFIX}XXXXXXXX.tar.gz")
                 if not isinstance(remote_tar, str): remote_tar = remote_tar.decode()
-                self.sess.upload_file(local_tar, remote_tar)
+                remote_tar = remote_tar.strip()
+                assert status == 0, f"Failed to create a temporary file: {remote_tar}"
+
+                with tracing.span("upload_tarball", self.cfg.name) as s:
+                    self.sess.upload_file(local_tar, remote_tar)
+                    s["bytes"] = os.path.getsize(local_tar)
 
-                untar = self.sess.run('cd %s && tar -xzf %s' % (sh_string(remote), sh_string(remote_tar)))
-                message = untar.recvrepeat(2)
+                # the tarball is removed on both ends as soon as it has been extracted
+                with tracing.span("untar", self.cfg.name):
+                    untar = self.sess.run('cd %s && tar -xzf %s; status=$?; rm -f %s; exit $status'
+                                          % (sh_string(remote), sh_string(remote_tar), sh_string(remote_tar)))
+                    message = untar.recvrepeat(2)
+                    status = untar.wait()
 
-                if untar.wait() != 0:
+                os.remove(local_tar)
+
+                if status != 0:
                     print("Could not untar %r on the remote end\n%s" % (remote_tar, message))
                     sys.exit(1)
 
@@ -119,6 +221,23 @@ class MachineAccess:
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.logout()
 
+def _dir_size(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            fp = os.path.join(root, f)
+            if not os.path.islink(fp):
+                total += os.path.getsize(fp)
+
+    return total
+
+# Returns the access wrapper appropriate for the machine's type
+def get_access(cfg, skip_unhealthy=False):
+    if cfg.machine_type == MachineType.LOCAL:
+        return LocalMachineAccess(cfg)
+
+    return MachineAccess(cfg, skip_unhealthy)
+
 if __name__ == "__main__":
     import yaml
     from .machine_credentials import CredentialPair
@@ -8,6 +8,8 @@ method for parsing this information from a config-file
 from dataclasses import dataclass
 from enum import Enum
 from .machine_credentials import CredentialPair
+from .machine_groups import has_pattern, pattern_values, substitute
+import getpass
 
 class DirType(Enum):
     LOCAL_DISK = 1
@@ -26,6 +28,38 @@ class DirType(Enum):
 
         assert False, "Directory type must be one of local, shared, or afs"
 
+class MachineType(Enum):
+    SSH = 1
+    LOCAL = 2
+
+    @classmethod
+    def parse(cls, x):
+        x = x.lower()
+        if x == "ssh":
+            return cls.SSH
+        if x == "local":
+            return cls.LOCAL
+
+        assert False, "Machine type must be one of ssh or local"
+
+# How a local machine populates a job's source directory
+class CopyMode(Enum):
+    COPY = 1
+    HARDLINK = 2
+    REFLINK = 3
+
+    @classmethod
+    def parse(cls, x):
+        x = x.lower()
+        if x == "copy":
+            return cls.COPY
+        if x == "hardlink":
+            return cls.HARDLINK
+        if x == "reflink":
+            return cls.REFLINK
+
+        assert False, "Copy mode must be one of copy, hardlink, or reflink"
+
 # Data structure for parsing and maintaining
 # user-provided information about a machine, 
 # including IPs, login info
@@ -38,9 +72,23 @@ class MachineConfig:
     tmpdir_type: DirType
     workdir: str
     workdir_type: DirType
+    machine_type: MachineType = MachineType.SSH
+    copy_mode: CopyMode = CopyMode.COPY
+    tags: tuple = ()
+    connect_timeout: float = 10 # seconds to establish the TCP connection
+    auth_timeout: float = 20 # further seconds to complete the SSH login
+
+    @property
+    def username(self):
+        return self.creds.username if self.creds else getpass.getuser()
 
     @classmethod
     def parseconfig(cls, name, cfg, creds):
+        machine_type = MachineType.parse(cfg.get("type", "ssh"))
+
+        if machine_type == MachineType.LOCAL:
+            return cls.parselocal(name, cfg, creds)
+
         assert "host" in cfg, "Machines must have a 'host' parameter for hostname/IP address"
 
         assert "creds" in cfg, "Machines must have a 'creds' parameter for credentials"
@@ -58,12 +106,57 @@ class MachineConfig:
         workdir = cfg["workdir"].replace(r"{username}", creds[cfg["creds"]].username)
 
         return cls(name, cfg["host"], creds[cfg["creds"]],
-                   tmpdir, tmpdir_type, workdir, workdir_type)
+                   tmpdir, tmpdir_type, workdir, workdir_type,
+                   tags=tuple(cfg.get("tags", [])),
+                   connect_timeout=float(cfg.get("connect_timeout", 10)),
+                   auth_timeout=float(cfg.get("auth_timeout", 20)))
+
+    # Local machines run jobs directly on this host, so they need
+    # neither a hostname nor credentials
+    @classmethod
+    def parselocal(cls, name, cfg, creds):
+        assert "tmpdir" in cfg, "Machines must have a temporary directory specified"
+        assert "workdir" in cfg, "Machines must have a working directory specified"
+
+        cred = None
+        if "creds" in cfg:
+            assert cfg["creds"] in creds, f"Credential pair {cfg['creds']} not found"
+            cred = creds[cfg["creds"]]
+
+        username = cred.username if cred else getpass.getuser()
+
+        tmpdir = cfg["tmpdir"].replace(r"{username}", username)
+        workdir = cfg["workdir"].replace(r"{username}", username)
+
+        return cls(name, cfg.get("host", "localhost"), cred,
+                   tmpdir, DirType.parse(cfg.get("tmpdir_type", "local")),
+                   workdir, DirType.parse(cfg.get("workdir_type", "local")),
+                   MachineType.LOCAL, CopyMode.parse(cfg.get("copy_mode", "copy")),
+                   tuple(cfg.get("tags", [])))
 
+    # Machine names may contain ranges such as cmu-linux-[15-18], in which case
+    # the host must contain the same ranges, i.e. linux-[15-18].andrew.cmu.edu
     @classmethod
     def parseall(cls, cfg, creds):
-        assert len(list(cfg.keys())) == len(set(cfg.keys())), "Machines must all have unique names"
-        return {k: cls.parseconfig(k, v, creds) for k, v in cfg.items()}
+        machines = {}
+        for k, v in cfg.items():
+            if not has_pattern(k):
+                assert k not in machines, f"Machines must all have unique names ({k})"
+                machines[k] = cls.parseconfig(k, v, creds)
+                continue
+
+            host = v.get("host", "localhost")
+            assert has_pattern(host) or v.get("type", "ssh") == "local", \
+                    f"Host of machine {k} must contain the same ranges as its name"
+            assert not has_pattern(host) or len(pattern_values(host)[0]) == len(pattern_values(k)[0]), \
+                    f"Host of machine {k} must contain the same ranges as its name"
+
+            for values in pattern_values(k):
+                name = substitute(k, values)
+                assert name not in machines, f"Machines must all have unique names ({name})"
+                machines[name] = cls.parseconfig(name, {**v, "host": substitute(host, values)}, creds)
+
+        return machines
 
 # Unit-test
 if __name__ == "__main__":
@@ -0,0 +1,121 @@
+"""
+machine_groups.py
+
+Provides utilities for referring to many machines at once: range patterns
+such as linux-[1-100].andrew.cmu.edu, named groups and tags which can be
+selected with @name, and running an operation against many machines
+concurrently while collecting the errors from each.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from .table_display import display_table
+import itertools
+import re
+
+_RANGE = re.compile(r"\[([0-9,\-]+)\]")
+
+# Expands a single bracketed range such as "1-3,7" into ["1", "2", "3", "7"],
+# keeping any zero-padding, i.e. "01-03" gives ["01", "02", "03"]
+def _expand_range(spec):
+    out = []
+    for part in spec.split(","):
+        if "-" in part:
+            lo, hi = part.split("-", 1)
+            assert lo.isdigit() and hi.isdigit() and int(lo) <= int(hi), f"Invalid range [{spec}]"
+            out += [str(i).zfill(len(lo)) for i in range(int(lo), int(hi)+1)]
+        else:
+            assert part.isdigit(), f"Invalid range [{spec}]"
+            out.append(part)
+
+    return out
+
+def has_pattern(s):
+    return _RANGE.search(s) is not None
+
+# Returns one tuple of values for each expansion of the ranges in `s`
+def pattern_values(s):
+    return list(itertools.product(*[_expand_range(x) for x in _RANGE.findall(s)]))
+
+# Substitutes one tuple of values (from pattern_values) into the ranges in `s`
+def substitute(s, values):
+    values = iter(values)
+    return _RANGE.sub(lambda _: next(values), s)
+
+def expand_pattern(s):
+    return [substitute(s, v) for v in pattern_values(s)]
+
+# Parses the optional 'groups' section of machines.yaml. Each group lists
+# machine names, range patterns, or other groups/tags as @name. Every tag
+# given to a machine is also usable as a group.
+def parse_groups(cfg, machines):
+    cfg = cfg or {}
+    assert "all" not in cfg, "The group name 'all' is reserved"
+
+    tagged = {}
+    for name, machine in machines.items():
+        for tag in machine.tags:
+            tagged.setdefault(tag, []).append(name)
+
+    names = set(tagged) | set(cfg)
+
+    def resolve(name, seen):
+        assert name not in seen, f"Group {name} includes itself"
+        members = list(tagged.get(name, []))
+
+        for entry in cfg.get(name, []):
+            if entry.startswith("@"):
+                assert entry[1:] in names, f"Group {name} includes unknown group {entry}"
+                members += resolve(entry[1:], seen + [name])
+            else:
+                for member in expand_pattern(entry):
+                    assert member in machines, f"Group {name} includes unknown machine {member}"
+                    members.append(member)
+
+        return list(dict.fromkeys(members))
+
+    return {name: resolve(name, []) for name in names}
+
+# Resolves a machine name, range pattern, or @group to a list of machine names
+def select_machines(selector, machines, groups):
+    if selector == "@all":
+        return list(machines)
+
+    if selector.startswith("@"):
+        assert selector[1:] in groups, f"Unknown group {selector}"
+        return groups[selector[1:]]
+
+    names = expand_pattern(selector)
+    for name in names:
+        assert name in machines, f"Unknown machine {name}"
+
+    return names
+
+# Calls fn(name) for each machine concurrently, returning
+# {name: (result, error)} where exactly one of the two is None
+def fan_out(names, fn, max_workers=32):
+    if len(names) == 0:
+        return {}
+
+    def run(name):
+        try:
+            return fn(name), None
+        except BaseException as e:
+            # includes SystemExit, so one machine can't end the whole operation
+            return None, e
+
+    with ThreadPoolExecutor(max_workers=min(len(names), max_workers)) as ex:
+        return dict(zip(names, ex.map(run, names)))
+
+# Prints a table of the machines which failed, returning whether any did
+def report_errors(title, results):
+    rows = [[name, str(err) or type(err).__name__] for name, (_, err) in results.items() if err is not None]
+
+    if len(rows) > 0:
+        display_table(title, ["Machine", "Error"], rows)
+
+    return len(rows) > 0
+
+# Unit-test
+if __name__ == "__main__":
+    print(expand_pattern("linux-[15-18].andrew.cmu.edu"))
+    print(expand_pattern("node[01-03,7]-[1-2]"))
+    print(pattern_values("cmu-linux-[15-16]"))
@@ -0,0 +1,101 @@
+"""
+machine_health.py
+
+HostHealth persistently tracks the outcome of logging into each machine,
+so that machines which are known to be down can be skipped rather than
+waited on for a full timeout every time. After several consecutive
+failures a machine is only retried occasionally, with the wait doubling
+after each further failure. As other invocations of tinymon record logins
+to the same file, each update holds a lock file and only changes the entry
+of the machine it is for.
+"""
+from .config import HEALTH_YAML, HEALTH_LOCK
+import fcntl
+import os
+import threading
+import time
+import yaml
+
+FAILURE_THRESHOLD = 3
+BASE_BACKOFF = 60
+MAX_BACKOFF = 3600
+
+class HostUnavailable(Exception):
+    pass
+
+class HostHealth:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.hosts = _load()
+
+    # Replaces a machine's entry with update(entry), applied to the entry
+    # as currently on disk, while keeping every other machine's entry. The
+    # file is written to a temporary file first, so it is never read
+    # half-written.
+    def _update(self, name, update):
+        with self.lock, open(HEALTH_LOCK, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            self.hosts = _load()
+            self.hosts[name] = update(self.hosts.get(name, {}))
+
+            tmp = f"{HEALTH_YAML}.{os.getpid()}.tmp"
+            with open(tmp, "w+") as f:
+                yaml.dump({"hosts": self.hosts}, f, yaml.Dumper)
+            os.replace(tmp, HEALTH_YAML)
+
+    def get(self, name):
+        return self.hosts.get(name, None)
+
+    def list(self):
+        return self.hosts
+
+    def record_success(self, name, login_time):
+        self._update(name, lambda host: {**host, "last_success": time.time(),
+                                         "consecutive_failures": 0, "login_time": round(login_time, 3),
+                                         "last_error": None})
+
+    def record_failure(self, name, error):
+        self._update(name, lambda host: {**host, "last_failure": time.time(),
+                                         "consecutive_failures": host.get("consecutive_failures", 0) + 1,
+                                         "last_error": describe_error(error)})
+
+    # Returns why a machine should be skipped, or None if it should be tried
+    def skip_reason(self, name):
+        host = self.hosts.get(name)
+        if host is None or host.get("consecutive_failures", 0) < FAILURE_THRESHOLD:
+            return None
+
+        failures = host["consecutive_failures"]
+        backoff = min(BASE_BACKOFF * 2 ** (failures - FAILURE_THRESHOLD), MAX_BACKOFF)
+        retry_in = host["last_failure"] + backoff - time.time()
+
+        if retry_in <= 0:
+            return None
+
+        return f"skipped after {failures} failures ({host['last_error']}), retrying in {int(retry_in)}s"
+
+def _load():
+    try:
+        with open(HEALTH_YAML) as f:
+            return yaml.load(f, yaml.Loader)["hosts"]
+    except:
+        return {}
+
+def describe_error(error):
+    msg = str(error).strip().split("\n")[0]
+    if len(msg) > 60: msg = msg[:57] + "..."
+
+    return f"{type(error).__name__}: {msg}" if msg else type(error).__name__
+
+_health = None
+_health_lock = threading.Lock()
+
+# Returns the HostHealth shared by all machine accesses in this process
+def get_health():
+    global _health
+    with _health_lock:
+        if _health is None:
+            _health = HostHealth()
+
+        return _health
@@ -6,8 +6,14 @@ status-information about a machine including its hardware specs
 and current utilization
 """
 from dataclasses import dataclass
-from .machine_access import MachineAccess
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from .machine_access import get_access
+from .machine_health import HostUnavailable, describe_error
 from .machine_config import DirType
+from .config import STATUS_CACHE_YAML
+import threading
+import time
+import yaml
 
 @dataclass
 class SysInfo:
@@ -110,8 +116,13 @@ class MachineStatus:
 
     @classmethod
     def populate(cls, machine):
+        return cls.try_populate(machine)[0]
+
+    # Returns (status, None), or (None, reason) if the status could not be retrieved
+    @classmethod
+    def try_populate(cls, machine, skip_unhealthy=False):
         try:
-            with MachineAccess(machine) as m:
+            with get_access(machine, skip_unhealthy) as m:
                 out = cls(
                     SysInfo.populate(m, machine),
                     CPUInfo.populate(m, machine),
@@ -119,9 +130,50 @@ class MachineStatus:
                     DiskInfo.populate(m, machine),
                 )
 
-            return out
-        except:
-            return None
+            cache_status(machine.name, out.cpu_info.cores, out.cpu_info.threads, out.mem_info.mem_total)
+            return out, None
+        except HostUnavailable as e:
+            return None, str(e)
+        except Exception as e:
+            return None, describe_error(e)
+
+_cache_lock = threading.Lock()
+
+def _load_cache():
+    try:
+        with open(STATUS_CACHE_YAML) as f:
+            return yaml.load(f, yaml.Loader) or {}
+    except:
+        return {}
+
+# Records the hardware specs of a machine, so they can be used without
+# logging in again (i.e. to fill in job templates)
+def cache_status(name, cores, threads, mem_gb):
+    with _cache_lock:
+        cache = _load_cache()
+        cache[name] = {"cores": cores, "threads": threads, "mem_gb": mem_gb, "time": time.time()}
+
+        with open(STATUS_CACHE_YAML, "w+") as f:
+            yaml.dump(cache, f, yaml.Dumper)
+
+def get_cached_status(name):
+    return _load_cache().get(name, None)
+
+# Retrieves the status of all machines concurrently, yielding (name, status,
+# reason) in the order that they complete. When sweeping over several
+# machines (or with `skip_unhealthy`), machines which are known to be down
+# are skipped, with the reason saying why.
+def populate_all(machines, max_workers=32, skip_unhealthy=None):
+    if len(machines) == 0:
+        return
+
+    if skip_unhealthy is None:
+        skip_unhealthy = len(machines) > 1
+
+    with ThreadPoolExecutor(max_workers=min(len(machines), max_workers)) as ex:
+        futures = {ex.submit(MachineStatus.try_populate, v, skip_unhealthy): k for k, v in machines.items()}
+        for future in as_completed(futures):
+            yield (futures[future],) + future.result()
 
 if __name__ == "__main__":
     import yaml
@@ -3,7 +3,8 @@ machine_status_table.py
 
 Display the information on all of the running machines
 """
-from .table_display import display_table
+from .table_display import display_table, stream_table, remaining_width
+import time
 
 def display_machine_list(machines):
     col_names = ["Name", "Host", "Username"]
@@ -12,30 +13,59 @@ def display_machine_list(machines):
         rows.append([
             name,
             info.host,
-            info.creds.username
+            info.username
         ])
 
     display_table("Machine List", col_names, rows)
 
+MACHINE_COLUMNS = ["Name", "Uptime", "Cores", "Freq", "CPU %", "RAM", "Temp FS", "Working FS", "Error"]
+
+def _machine_row(name, info, reason=None):
+    if info is None:
+        return [name, "Unknown"] + ["" for _ in range(len(MACHINE_COLUMNS)-3)] + [reason or ""]
+
+    return [
+        name,
+        info.sys_info.uptime,
+        f"{info.cpu_info.cores}C/{info.cpu_info.threads}T",
+        info.cpu_info.cpu_freq,
+        str(info.cpu_info.avg_util)+"%",
+        f"{info.mem_info.mem_used}G/{info.mem_info.mem_total}G",
+        f"{info.disk_info.tmpfs_used}G/{info.disk_info.tmpfs_total}G",
+        f"{info.disk_info.workfs_used}G/{info.disk_info.workfs_total}G",
+        "",
+    ]
+
 def display_machines(machines):
-    col_names = ["Name", "Uptime", "Cores", "Freq", "CPU %", "RAM", "Temp FS", "Working FS"]
+    rows = [_machine_row(name, info) for name, info in machines.items()]
+    display_table("Machine Statuses", MACHINE_COLUMNS, rows)
+
+# Displays each machine's status as soon as it is retrieved. `statuses`
+# yields (name, status, reason) tuples, and `names` are all of the machine names.
+def stream_machines(names, statuses):
+    # the widths of typical values, as they aren't known in advance, with
+    # the rest of the terminal left for errors
+    widths = [max([len(x) for x in names] + [0]), 12, 8, 7, 6, 13, 15, 15]
+    widths.append(remaining_width(widths))
+    stream_table("Machine Statuses", MACHINE_COLUMNS,
+                 (_machine_row(name, info, reason) for name, info, reason in statuses), widths)
+
+def display_machine_health(machines, health):
+    col_names = ["Name", "Last Success", "Failures", "Login Time", "Last Error"]
     rows = []
-    for name, info in machines.items():
-        if info is None:
-            rows.append([name, "Unknown"] + ["" for _ in range(len(col_names)-2)])
-        else:
-            rows.append([
-                name,
-                info.sys_info.uptime,
-                f"{info.cpu_info.cores}C/{info.cpu_info.threads}T",
-                info.cpu_info.cpu_freq,
-                str(info.cpu_info.avg_util)+"%",
-                f"{info.mem_info.mem_used}G/{info.mem_info.mem_total}G",
-                f"{info.disk_info.tmpfs_used}G/{info.disk_info.tmpfs_total}G",
-                f"{info.disk_info.workfs_used}G/{info.disk_info.workfs_total}G",
-            ])
-
-    display_table("Machine Statuses", col_names, rows)
+    for name in machines:
+        host = health.get(name) or {}
+        last = host.get("last_success")
+
+        rows.append([
+            name,
+            time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(last)) if last else "Never",
+            str(host.get("consecutive_failures", 0)),
+            f"{host['login_time']}s" if host.get("login_time") is not None else "",
+            host.get("last_error") or "",
+        ])
+
+    display_table("Machine Health", col_names, rows)
 
 if __name__ == "__main__":
     import yaml
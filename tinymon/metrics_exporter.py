@@ -0,0 +1,264 @@
+"""
+metrics_exporter.py
+
+Serves machine and job state in the OpenMetrics text format over HTTP, for
+scraping by Prometheus. Machine statuses are retrieved by a background
+collector on a fixed interval, and scrapes only render the most recently
+collected values, so they never wait on SSH regardless of the number of
+machines.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from .machine_status import populate_all
+from .machine_health import get_health
+from .machine_config import DirType
+from .job_state_manager import JobStateManager
+from .job_manager import job_failed
+import sys
+import threading
+import time
+
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+GB = 1024 * 1024 * 1024
+DURATION_BUCKETS = [60, 300, 900, 3600, 4*3600, 12*3600, 86400, 7*86400]
+
+# Escapes a label value as required by the OpenMetrics text format
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _labels(**labels):
+    if len(labels) == 0:
+        return ""
+
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + "}"
+
+def _job_state(job):
+    if job["active"]:
+        return "running"
+    if job.get("requeued_as"):
+        return "relaunched"
+    if job.get("requeue_at"):
+        return "waiting_to_relaunch"
+    # jobs started before exit statuses were recorded
+    if job.get("exit_code") is None and not job.get("status_file"):
+        return "completed"
+
+    return "failed" if job_failed(job) else "succeeded"
+
+class MetricFamily:
+    def __init__(self, name, mtype, help_text, unit=None):
+        self.name = name
+        self.mtype = mtype
+        self.help_text = help_text
+        self.unit = unit
+        self.samples = []
+
+    def add(self, value, suffix="", **labels):
+        self.samples.append((self.name + suffix, labels, value))
+
+    def render(self):
+        lines = [f"# TYPE {self.name} {self.mtype}"]
+        if self.unit:
+            lines.append(f"# UNIT {self.name} {self.unit}")
+        lines.append(f"# HELP {self.name} {self.help_text}")
+
+        for name, labels, value in self.samples:
+            lines.append(f"{name}{_labels(**labels)} {value}")
+
+        return "\n".join(lines)
+
+class MetricsCollector:
+    def __init__(self, machines, interval=60):
+        self.machines = machines
+        self.interval = interval
+        self.lock = threading.Lock()
+
+        self.statuses = {} # name -> (status, reason, time collected)
+        self.jobs = {}
+        self.last_duration = None
+        self.last_success = None
+        self.cycles = 0
+        self.failed_cycles = 0
+        self.last_failed = False
+
+    def start(self):
+        t = threading.Thread(target=self.run, daemon=True)
+        t.start()
+        return t
+
+    # A failed cycle is logged and counted rather than ending the thread,
+    # which would leave the endpoint serving the same values forever
+    def run(self):
+        while True:
+            start = time.time()
+            try:
+                self.collect()
+            except Exception as e:
+                print(f"Metrics collection failed: {e}", file=sys.stderr)
+                with self.lock:
+                    self.failed_cycles += 1
+                    self.last_failed = True
+
+            time.sleep(max(self.interval - (time.time() - start), 0))
+
+    # Refreshes all of the cached values. Job state is re-read from disk as
+    # it is updated by other invocations of tinymon, and each machine's
+    # status is stored as soon as it arrives.
+    def collect(self):
+        start = time.time()
+
+        try:
+            jobs = dict(JobStateManager().list())
+            with self.lock:
+                self.jobs = jobs
+        except Exception as e:
+            print(f"Failed to read job state: {e}")
+
+        for name, status, reason in populate_all(self.machines):
+            with self.lock:
+                self.statuses[name] = (status, reason, time.time())
+
+        with self.lock:
+            self.last_duration = time.time() - start
+            self.last_success = time.time()
+            self.cycles += 1
+            self.last_failed = False
+
+    # Renders the cached values, without contacting any machines
+    def render(self):
+        with self.lock:
+            statuses = dict(self.statuses)
+            jobs = dict(self.jobs)
+            last_duration, last_success, cycles = self.last_duration, self.last_success, self.cycles
+            failed_cycles, last_failed = self.failed_cycles, self.last_failed
+
+        families = self._machine_families(statuses) + self._job_families(jobs)
+
+        collector = MetricFamily("tinymon_collector_cycles", "counter", "Completed collection cycles")
+        collector.add(cycles, "_total")
+
+        failed = MetricFamily("tinymon_collector_failed_cycles", "counter", "Collection cycles which failed")
+        failed.add(failed_cycles, "_total")
+
+        error = MetricFamily("tinymon_collector_error", "gauge", "Whether the last collection cycle failed")
+        error.add(1 if last_failed else 0)
+        families += [collector, failed, error]
+
+        if last_success is not None:
+            duration = MetricFamily("tinymon_collector_duration_seconds", "gauge",
+                                    "Time taken by the last collection cycle", "seconds")
+            duration.add(round(last_duration, 3))
+
+            finished = MetricFamily("tinymon_collector_last_success_timestamp_seconds", "gauge",
+                                    "When the last collection cycle finished", "seconds")
+            finished.add(round(last_success, 3))
+            families += [duration, finished]
+
+        return "\n".join(x.render() for x in families) + "\n# EOF\n"
+
+    def _machine_families(self, statuses):
+        up = MetricFamily("tinymon_machine_up", "gauge", "Whether the machine's status could be retrieved")
+        collected = MetricFamily("tinymon_machine_last_collected_timestamp_seconds", "gauge",
+                                 "When the machine's status was last retrieved", "seconds")
+        cores = MetricFamily("tinymon_machine_cpu_cores", "gauge", "Physical CPU cores")
+        threads = MetricFamily("tinymon_machine_cpu_threads", "gauge", "Hardware CPU threads")
+        util = MetricFamily("tinymon_machine_cpu_utilization_ratio", "gauge", "Average CPU utilization", "ratio")
+        mem_used = MetricFamily("tinymon_machine_memory_used_bytes", "gauge", "Memory in use", "bytes")
+        mem_total = MetricFamily("tinymon_machine_memory_total_bytes", "gauge", "Total memory", "bytes")
+        disk_used = MetricFamily("tinymon_machine_disk_used_bytes", "gauge", "Disk space in use", "bytes")
+        disk_free = MetricFamily("tinymon_machine_disk_free_bytes", "gauge", "Disk space available", "bytes")
+        login = MetricFamily("tinymon_machine_login_seconds", "gauge", "Time taken by the last successful login", "seconds")
+        failures = MetricFamily("tinymon_machine_login_failures", "gauge", "Consecutive failed logins")
+
+        health = get_health()
+        for name, (status, reason, when) in sorted(statuses.items()):
+            up.add(0 if status is None else 1, machine=name)
+            collected.add(round(when, 3), machine=name)
+
+            host = health.get(name) or {}
+            failures.add(host.get("consecutive_failures", 0), machine=name)
+            if host.get("login_time") is not None:
+                login.add(host["login_time"], machine=name)
+
+            if status is None: continue
+
+            cores.add(status.cpu_info.cores, machine=name)
+            threads.add(status.cpu_info.threads, machine=name)
+            util.add(round(status.cpu_info.avg_util / 100, 4), machine=name)
+            mem_used.add(int(status.mem_info.mem_used * GB), machine=name)
+            mem_total.add(int(status.mem_info.mem_total * GB), machine=name)
+
+            # df reports used and available space, whereas AFS quotas report
+            # used space and the total quota
+            disk = status.disk_info
+            for fs, used, other, dirtype in [("tmpdir", disk.tmpfs_used, disk.tmpfs_total, self.machines[name].tmpdir_type),
+                                             ("workdir", disk.workfs_used, disk.workfs_total, self.machines[name].workdir_type)]:
+                free = other - used if dirtype == DirType.AFS else other
+                disk_used.add(int(used * GB), machine=name, dir=fs)
+                disk_free.add(int(free * GB), machine=name, dir=fs)
+
+        return [up, collected, cores, threads, util, mem_used, mem_total, disk_used, disk_free, login, failures]
+
+    def _job_families(self, jobs):
+        counts = MetricFamily("tinymon_jobs", "gauge", "Tracked jobs by machine and state")
+        running = MetricFamily("tinymon_job_running_seconds", "gauge", "How long each running job has been running", "seconds")
+        durations = MetricFamily("tinymon_job_duration_seconds", "histogram", "Running time of finished jobs", "seconds")
+
+        by_state = {}
+        finished = {} # job name -> list of durations
+        now = time.time()
+
+        for jid, job in jobs.items():
+            state = _job_state(job)
+            key = (job["machine"], state)
+            by_state[key] = by_state.get(key, 0) + 1
+
+            if state == "running":
+                running.add(round(now - job["start_time"], 3), id=jid, name=job["name"], machine=job["machine"])
+            elif job.get("end_time") is not None:
+                finished.setdefault(job["name"], []).append(max(job["end_time"] - job["start_time"], 0))
+
+        for (machine, state), count in sorted(by_state.items()):
+            counts.add(count, machine=machine, state=state)
+
+        for name, values in sorted(finished.items()):
+            for le in DURATION_BUCKETS:
+                durations.add(sum(1 for x in values if x <= le), "_bucket", name=name, le=f"{float(le)}")
+
+            durations.add(len(values), "_bucket", name=name, le="+Inf")
+            durations.add(len(values), "_count", name=name)
+            durations.add(round(sum(values), 3), "_sum", name=name)
+
+        return [counts, running, durations]
+
+def serve_metrics(machines, host="127.0.0.1", port=9105, interval=60):
+    collector = MetricsCollector(machines, interval)
+    collector.start()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+
+            body = collector.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        # scrapes are too frequent to log each one
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    print(f"Serving metrics for {len(machines)} machines on http://{host}:{port}/metrics, "
+          f"refreshing every {interval}s")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,237 @@
+"""
+result_collection.py
+
+Extracts records from the logs or result files of many jobs at once. The
+extraction runs on each machine, with a single command for all of its jobs
+and all machines in parallel, so only the extracted records are transferred
+rather than whole logs or results directories. Records are streamed into a
+single table (or CSV/JSONL file) as each machine responds.
+"""
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from .machine_access import get_access
+from .job_manager import log_cmd
+from .machine_groups import report_errors
+from .table_display import stream_table, is_machine_readable, remaining_width
+import csv
+import json
+import os
+import re
+import secrets
+import shlex
+import sys
+
+# Globs may only contain these, as they are expanded by the remote shell
+_SAFE_GLOB = re.compile(r"[A-Za-z0-9_./*?\[\]-]+")
+
+# Python regex syntax which grep -E rejects or reads differently: escapes
+# such as \d or \w, lazy quantifiers, and (?...) groups other than named
+# and non-capturing ones (i.e. lookarounds)
+_NOT_ERE = re.compile(r"\\[A-Za-z0-9]|[*+?}]\?|\((?!\?P<[A-Za-z_][A-Za-z0-9_]*>|\?:)\?")
+
+# Column names for the records extracted with a pattern: one per capture
+# group, using the group's name if it has one
+def group_columns(pattern):
+    if pattern is None:
+        return []
+
+    regex = re.compile(pattern)
+    names = {v: k for k, v in regex.groupindex.items()}
+    return [names.get(i, f"group_{i}") for i in range(1, regex.groups + 1)]
+
+# The pattern for grep to select lines on the machines. Named and
+# non-capturing groups are only used to extract the values locally, so they
+# are made plain groups. Patterns which grep can't match the same way are
+# only matched locally, so the machines send every line (returns None).
+def _remote_pattern(pattern):
+    if _NOT_ERE.search(pattern):
+        return None
+
+    return re.sub(r"\(\?P<[A-Za-z_][A-Za-z0-9_]*>", "(", pattern).replace("(?:", "(")
+
+# Builds one command which extracts from all of the given jobs on a machine.
+# Each job's output follows a marker line, which includes a random token so
+# that it can't be confused with the jobs' own output.
+def _extract_cmd(states, token, pattern=None, glob=None, stream="stdout"):
+    remote = _remote_pattern(pattern) if pattern is not None else None
+    grep = f" | grep -E -- {shlex.quote(remote)} 2>/dev/null" if remote is not None else ""
+
+    # awk ends the last line of the output with a newline if it is missing,
+    # so the next marker always starts on its own line
+    cmds = []
+    for state in states:
+        cmds.append(f"echo {token} job {state['id']}")
+
+        if glob is None:
+            cmds.append(f"{{ {log_cmd(state, stream)}; }} 2>/dev/null | awk 1{grep}")
+        else:
+            # each file is output after its own marker, or with a pattern
+            # only its matching lines are
+            results = shlex.quote(state["results_dir"])
+            cmds.append(f"(cd {results} 2>/dev/null && for f in {glob}; do [ -f \"$f\" ] && "
+                        f"echo {token} file \"$f\" && {{ awk 1 \"$f\"{grep}; true; }}; done)")
+
+    return "; ".join(cmds) + "; true"
+
+# Splits the output of _extract_cmd into {jid: [(file, line)]}
+def _parse_output(out, token):
+    records = {}
+    jid = None
+    file = ""
+
+    for line in out.splitlines():
+        if line.startswith(token + " "):
+            kind, value = line[len(token)+1:].split(" ", 1)
+            if kind == "job":
+                jid = int(value)
+                file = ""
+                records[jid] = []
+            else:
+                file = value
+            continue
+
+        if jid is not None:
+            records[jid].append((file, line))
+
+    return records
+
+def _collect_machine(machine, states, token, pattern, glob, stream):
+    with get_access(machine) as m:
+        out, _ = m.run_to_end(_extract_cmd(states, token, pattern, glob, stream))
+
+    if not isinstance(out, str): out = out.decode(errors="replace")
+    return _parse_output(out, token)
+
+# Converts the extracted lines of a job into table rows
+def _rows(state, lines, pattern, glob):
+    regex = re.compile(pattern) if pattern is not None else None
+    groups = regex.groups if regex is not None else 0
+    prefix = [str(state["id"]), state["name"], state["machine"]]
+
+    if glob is not None and regex is None:
+        # without a pattern, each file is a single record
+        files = {}
+        for file, line in lines:
+            files.setdefault(file, []).append(line)
+
+        return [prefix + [file, "\n".join(content)] for file, content in files.items()]
+
+    rows = []
+    for file, line in lines:
+        match = regex.search(line) if regex is not None else None
+        if regex is not None and match is None: continue
+
+        values = [(match.group(i) or "") if match else "" for i in range(1, groups + 1)]
+        rows.append(prefix + ([file] if glob is not None else []) + [line] + values)
+
+    return rows
+
+# Runs the extraction on every machine concurrently, yielding the rows of
+# each machine as soon as it responds. Errors from each machine are stored
+# in `errors` as {name: (None, error)}.
+def collect_rows(machines, states, pattern, glob, stream, errors, max_workers=32):
+    by_machine = {}
+    for state in states:
+        by_machine.setdefault(state["machine"], []).append(state)
+
+    if len(by_machine) == 0:
+        return
+
+    token = "@@tinymon-" + secrets.token_hex(8)
+
+    with ThreadPoolExecutor(max_workers=min(len(by_machine), max_workers)) as ex:
+        futures = {ex.submit(_collect_machine, machines[name], by_machine[name], token, pattern, glob, stream): name
+                   for name in by_machine}
+
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                records = future.result()
+            except Exception as e:
+                errors[name] = (None, e)
+                continue
+
+            for state in by_machine[name]:
+                yield from _rows(state, records.get(state["id"], []), pattern, glob)
+
+def job_collect(machines, jm, jids, pattern=None, glob=None, stream="stdout", outfile=None):
+    assert pattern is not None or glob is not None, "Either a pattern or a file glob must be given"
+    if glob is not None:
+        assert _SAFE_GLOB.fullmatch(glob) and not glob.startswith("/") and ".." not in glob.split("/"), \
+                f"Invalid file glob {glob}, must be a relative path"
+
+    states = []
+    for jid in jids:
+        state = jm.get(jid)
+        assert state is not None, f"Job ID {jid} doesn't exist"
+
+        if glob is not None and state["results_dir"] is None:
+            print(f"Skipping job ID {jid}, which does not have a results directory")
+        elif glob is None and stream == "stderr" and not state.get("logging"):
+            print(f"Skipping job ID {jid}, which does not capture stderr separately")
+        elif state.get("collected"):
+            print(f"Skipping job ID {jid}, which has been removed from its machine by 'tinymon gc'")
+        else:
+            states.append(state)
+
+    if pattern is not None and glob is None:
+        col_names = ["Job ID", "Name", "Machine", "Line"] + group_columns(pattern)
+    elif pattern is not None:
+        col_names = ["Job ID", "Name", "Machine", "File", "Line"] + group_columns(pattern)
+    else:
+        col_names = ["Job ID", "Name", "Machine", "File", "Content"]
+
+    if pattern is not None and _remote_pattern(pattern) is None:
+        print("The pattern uses syntax which grep -E does not support, so whole logs or files are matched locally",
+              file=sys.stderr)
+
+    errors = {}
+    rows = collect_rows(machines, states, pattern, glob, stream, errors)
+
+    if outfile is None:
+        if not is_machine_readable():
+            rows = ([x.replace("\n", "\\n") for x in row] for row in rows)
+
+        stream_table("Collected Results", col_names, rows, _widths(states, col_names, glob))
+    else:
+        count = _write_rows(outfile, col_names, rows)
+        print(f"Wrote {count} records from {len(states)} jobs to {outfile}")
+
+    report_errors("Failed to Collect", errors)
+    return errors
+
+# Column widths for streaming the records as a table. The job columns fit
+# every job, while the line (or file content) takes the rest of the
+# terminal and the captured values get a typical width, as neither are
+# known in advance.
+def _widths(states, col_names, glob):
+    widths = [max([len(str(x["id"])) for x in states] + [0]),
+              max([len(x["name"]) for x in states] + [0]),
+              max([len(x["machine"]) for x in states] + [0])]
+    if glob is not None:
+        widths.append(24)
+
+    values = [12 for _ in range(len(col_names) - len(widths) - 1)]
+    return widths + [remaining_width(widths + values)] + values
+
+# Writes rows to a CSV, TSV, or JSONL file (by its extension) as they
+# arrive, returning the number written
+def _write_rows(outfile, col_names, rows):
+    ext = os.path.splitext(outfile)[1].lower()
+    assert ext in (".csv", ".tsv", ".jsonl"), "Output file must be .csv, .tsv, or .jsonl"
+
+    count = 0
+    with open(outfile, "w", newline="") as f:
+        if ext == ".jsonl":
+            for row in rows:
+                f.write(json.dumps(dict(zip(col_names, row))) + "\n")
+                f.flush()
+                count += 1
+        else:
+            writer = csv.writer(f, delimiter="," if ext == ".csv" else "\t", lineterminator="\n")
+            writer.writerow(col_names)
+            for row in rows:
+                writer.writerow(row)
+                f.flush()
+                count += 1
+
+    return count
@@ -1,37 +1,100 @@
 """
 table_display.py
 
-Module for displaying tabular data with ASCII formatting
+Module for displaying tabular data with ASCII formatting, or as one
+machine-readable record per line (JSON, CSV, or TSV)
 """
 from termcolor import colored, cprint
+import csv
+import json
+import shutil
+import sys
+
+FORMATS = ["table", "json", "csv", "tsv"]
+_output_format = "table"
+
+def set_output_format(fmt):
+    global _output_format
+    assert fmt in FORMATS, f"Output format must be one of {', '.join(FORMATS)}"
+    _output_format = fmt
+
+def is_machine_readable():
+    return _output_format != "table"
 
 def display_table(title, col_names, rows):
+    if is_machine_readable():
+        stream_table(title, col_names, rows)
+        return
+
     cprint(title, "green")
     print()
     widths = [max([len(col_names[i])]+[len(row[i]) for row in rows]) for i in range(len(col_names))]
     _print_table(col_names, rows, widths)
 
-# Utility function for printing a table
-def _print_table(col_names, rows, widths):
-    total_width = sum(widths) + 3*(len(widths)-1) + 4
+# Displays each row as soon as it is produced by `rows`, rather than waiting
+# for all of them. As the header is printed before any rows are known, the
+# columns are fixed at `widths` (or the width of the column names), and
+# longer fields are truncated. Without `widths`, the rows are all collected
+# first and displayed with display_table.
+def stream_table(title, col_names, rows, widths=None):
+    if _output_format == "json":
+        for row in rows:
+            print(json.dumps(dict(zip(col_names, row))), flush=True)
+        return
 
-    BAR = colored("|", "blue", attrs=["bold"])
-    cprint(f"{BAR} ", end="")
-    cprint(f" {BAR} ".join(colored(x, attrs=["bold"]) for x in _justify_all(col_names, widths)),
-           attrs=["bold"], end="")
-    cprint(f" {BAR}")
+    if _output_format in ("csv", "tsv"):
+        writer = csv.writer(sys.stdout, delimiter="," if _output_format == "csv" else "\t",
+                            lineterminator="\n")
+        writer.writerow(col_names)
+        sys.stdout.flush()
+
+        for row in rows:
+            writer.writerow(row)
+            sys.stdout.flush()
+        return
+
+    if widths is None:
+        display_table(title, col_names, list(rows))
+        return
+
+    widths = [max(len(col_names[i]), widths[i]) for i in range(len(col_names))]
+
+    cprint(title, "green")
+    print()
+    _print_header(col_names, widths)
+
+    for row in rows:
+        print(_format_row([_truncate(row[i], widths[i]) for i in range(len(widths))], widths), flush=True)
+
+    print()
+
+# The width left on the terminal for one column of a table, given the
+# widths of the other columns
+def remaining_width(widths, minimum=20):
+    return max(shutil.get_terminal_size().columns - sum(widths) - 3 * len(widths) - 4, minimum)
 
-    cprint(f"|-", "blue", attrs=["bold"], end="")
-    cprint(f"-|-".join("-"*x for x in widths), "blue", attrs=["bold"], end="")
-    cprint(f"-|", "blue", attrs=["bold"])
+def _truncate(field, width):
+    return field if len(field) <= width else field[:width-1] + "…"
+
+# Utility function for printing a table
+def _print_table(col_names, rows, widths):
+    _print_header(col_names, widths)
 
     for row in rows:
-        cprint(f"{BAR} ", end="")
-        cprint(f" {BAR} ".join(_justify_all(row, widths)), end="")
-        cprint(f" {BAR}")
+        print(_format_row(row, widths))
 
     print()
 
+def _print_header(col_names, widths):
+    print(_format_row([colored(x, attrs=["bold"]) for x in _justify_all(col_names, widths)],
+                      [0 for _ in widths]))
+    print(colored("|-" + "-|-".join("-"*x for x in widths) + "-|", "blue", attrs=["bold"]))
+
+# Formats a single line of the table, so that it can be printed at once
+def _format_row(fields, widths):
+    BAR = colored("|", "blue", attrs=["bold"])
+    return f"{BAR} " + f" {BAR} ".join(_justify_all(fields, widths)) + f" {BAR}"
+
 # Justify all fields in a line to the respective widths
 def _justify_all(fields, widths):
     assert len(fields) == len(widths)
@@ -1,30 +1,104 @@
 import sys, shutil
 import yaml
-from tqdm import tqdm
 from termcolor import colored, cprint
 from .config import *
 from .machine_credentials import CredentialPair
 from .machine_config import MachineConfig
-from .machine_status import MachineStatus
+from .machine_status import MachineStatus, populate_all
 from .job_config import JobConfig
 from .job_state_manager import JobStateManager
 from .job_manager import *
-from .machine_status_table import display_machine_list, display_machines
+from .workflow import workflow_run
+from .garbage_collect import gc_run, parse_duration, parse_size
+from .metrics_exporter import serve_metrics
+from .result_collection import job_collect
+from .machine_status_table import display_machine_list, stream_machines, display_machine_health
+from .machine_health import get_health
+from .table_display import FORMATS, set_output_format
+from .machine_groups import parse_groups, select_machines
+from . import tracing
 
 def usage():
     print("Usage:")
     print("  tinymon machine list   :  list all available machines")
-    print("  tinymon machine status :  get status of all available machines")
+    print("  tinymon machine status [machines] :  get status of all available machines, or only the given machines")
+    print("  tinymon machine health [machines] :  show recent login successes and failures of each machine")
     print("  tinymon job list  :  list all currently-active jobs")
-    print("  tinymon job start (job yaml) (machine) [arg1=val1] [arg2=val2] ...  :  start the job specified in the YAML file")
-    print("  tinymon job status (id) :  get the status of a specific job")
+    print("  tinymon job start (job yaml) (machines) [arg1=val1] [arg2=val2] ... [--queue] :  start the job specified in the YAML file")
+    print("  tinymon job status (id | machines) ... :  get the status of specific jobs, or all jobs on the given machines")
+    print("  tinymon job wait (id) [id] ... | --all :  wait for jobs to complete, failing if any job failed")
     print("  tinymon job retrieve (id) (destination dir) :  pull results from a specific job")
-    print("  tinymon job logs (id)  :  get logs from a specific job")
-    print("  tinymon job kill (id)  :  forcibly terminate a specific job")
+    print("  tinymon job collect (id | machines) ... (--grep PATTERN | --file GLOB [--grep PATTERN]) [--stderr] [--name JOB NAME] [--output FILE] :  extract matching lines or files from many jobs into one table")
+    print("  tinymon job sync (id) :  copy the results of a staged job into its workdir, if they were not already")
+    print("  tinymon job logs (id) [--stderr] [--grep PATTERN] :  get logs from a specific job, optionally only matching lines")
+    print("  tinymon job kill (id | machines) ... :  forcibly terminate specific jobs, or all jobs on the given machines")
+    print("  tinymon workflow run (workflow yaml)  :  run all stages of a multi-stage workflow")
+    print("  tinymon serve-metrics [machines] [--port 9105] [--bind 127.0.0.1] [--interval 60] :  serve machine and job metrics for Prometheus")
+    print("  tinymon gc [machines] [--dry-run] [--archive] [--include-untracked] [--older-than 7d] [--min-size 0] :  remove directories left by completed jobs")
+    print()
+    print("Machines may be given as a name, a range pattern such as linux-[15-18], or @group")
+    print()
+    print("Options (may be given with any command):")
+    print("  --trace (file) :  write a Chrome trace-event JSON of all remote operations")
+    print("  --profile      :  print a summary of time spent in remote operations")
+    print("  --format (table|json|csv|tsv) :  output tables as text or one record per line")
     sys.exit(1)
 
+# Strips the global options out of sys.argv, returning (trace file, profile, format)
+def parse_options():
+    trace_file = None
+    profile = False
+    fmt = "table"
+
+    argv = [sys.argv[0]]
+    i = 1
+    while i < len(sys.argv):
+        if sys.argv[i] == "--trace":
+            if i + 1 >= len(sys.argv):
+                print("Usage: --trace (file)")
+                sys.exit(1)
+
+            trace_file = sys.argv[i+1]
+            i += 2
+
+        elif sys.argv[i] == "--profile":
+            profile = True
+            i += 1
+
+        elif sys.argv[i] == "--format":
+            if i + 1 >= len(sys.argv) or sys.argv[i+1] not in FORMATS:
+                print(f"Usage: --format ({'|'.join(FORMATS)})")
+                sys.exit(1)
+
+            fmt = sys.argv[i+1]
+            i += 2
+
+        else:
+            argv.append(sys.argv[i])
+            i += 1
+
+    sys.argv = argv
+    return trace_file, profile, fmt
+
 def main():
-    if len(sys.argv) < 3:
+    trace_file, profile, fmt = parse_options()
+    set_output_format(fmt)
+
+    if trace_file or profile:
+        tracing.enable()
+
+    try:
+        run_command()
+    finally:
+        if trace_file:
+            tracing.write_chrome_trace(trace_file)
+            print(f"Wrote trace to {trace_file}", file=sys.stderr)
+
+        if profile:
+            tracing.print_profile()
+
+def run_command():
+    if len(sys.argv) < 2 or (len(sys.argv) < 3 and sys.argv[1] not in ("gc", "serve-metrics")):
         usage()
 
     if not os.path.exists(MACHINES_YAML):
@@ -38,21 +112,44 @@ def main():
         print(f"Please populate {MACHINES_YAML} with information on your available machines.")
         sys.exit(1)
 
-    creds = CredentialPair.parseall(machines["credentials"])
+    creds = CredentialPair.parseall(machines.get("credentials", {}))
+    groups = machines.get("groups", {})
     machines = MachineConfig.parseall(machines["machines"], creds)
+    groups = parse_groups(groups, machines)
     jm = JobStateManager()
 
+    # Resolves machine names, range patterns, and @groups
+    def select(selectors):
+        try:
+            return list(dict.fromkeys(sum((select_machines(x, machines, groups) for x in selectors), [])))
+        except AssertionError as e:
+            print(f"Error: {e}")
+            sys.exit(1)
+
+    # Resolves job IDs, or machine selectors to all of their active jobs
+    def select_jobs(selectors):
+        jids = []
+        for x in selectors:
+            if x.isdigit():
+                jids.append(int(x))
+            else:
+                names = select([x])
+                jids += [jid for jid, job in jm.list().items() if job["active"] and job["machine"] in names]
+
+        return list(dict.fromkeys(jids))
+
     if sys.argv[1] == "machine":
         if sys.argv[2] == "list":
             display_machine_list(machines)
 
         elif sys.argv[2] == "status":
-            print("Retrieving machine statuses. This may take a while.")
-            statuses = {}
-            for k, v in tqdm(machines.items()):
-                statuses[k] = MachineStatus.populate(v)
+            selected = {k: machines[k] for k in select(sys.argv[3:] or ["@all"])}
 
-            display_machines(statuses)
+            print("Retrieving machine statuses. This may take a while.", file=sys.stderr)
+            stream_machines(list(selected), populate_all(selected))
+
+        elif sys.argv[2] == "health":
+            display_machine_health(select(sys.argv[3:] or ["@all"]), get_health())
 
         else:
             print(f"Invalid subcommand '{sys.argv[1]} {sys.argv[2]}'")
@@ -75,8 +172,12 @@ def main():
                 print("Usage: tinymon start (job yaml) (machine) [arg1=val1] [arg2=val2]")
                 sys.exit(1)
 
+            queue = "--queue" in sys.argv[5:]
+
             args = {}
             for x in sys.argv[5:]:
+                if x == "--queue": continue
+
                 x = x.split("=")
                 if len(x) == 1:
                     print(f"Invalid argument {x}. Must be in 'arg=val' style key-value pairs")
@@ -84,17 +185,36 @@ def main():
 
                 args[x[0]] = "=".join(x[1:])
 
-            job_start(machines, jm, machine, yamlfile, args)
+            names = select([machine])
+            if len(names) == 1 and names[0] == machine:
+                job_start(machines, jm, machine, yamlfile, args, queue=queue)
+            else:
+                job_start_many(machines, jm, names, yamlfile, args, queue)
 
         elif sys.argv[2] == "status":
-            try:
-                jid = int(sys.argv[3])
-            except:
-                print("Usage: tinymon status (id)")
-                print("Specified job ID must be numeric")
+            if len(sys.argv) < 4:
+                print("Usage: tinymon status (id | machines) ...")
                 sys.exit(1)
 
-            job_check(machines, jid, jm)
+            if len(sys.argv) == 4 and sys.argv[3].isdigit():
+                job_check(machines, int(sys.argv[3]), jm)
+            else:
+                job_status_many(machines, select_jobs(sys.argv[3:]), jm)
+
+        elif sys.argv[2] == "wait":
+            if sys.argv[3:] == ["--all"]:
+                jids = [jid for jid, job in jm.list().items() if job["active"]]
+            else:
+                try:
+                    jids = [int(x) for x in sys.argv[3:]]
+                    assert len(jids) > 0
+                except:
+                    print("Usage: tinymon wait (id) [id] ... | --all")
+                    print("Specified job IDs must be numeric")
+                    sys.exit(1)
+
+            if len(job_wait(machines, jids, jm)) > 0:
+                sys.exit(1)
 
         elif sys.argv[2] == "retrieve":
             try:
@@ -112,30 +232,179 @@ def main():
 
             job_retrieve(machines, jid, jm, dest)
 
-        elif sys.argv[2] == "logs":
+        elif sys.argv[2] == "collect":
+            usage_str = "Usage: tinymon collect (id | machines) ... (--grep PATTERN | --file GLOB [--grep PATTERN]) " \
+                        "[--stderr] [--name JOB NAME] [--output FILE]"
+            selectors = []
+            opts = {"pattern": None, "glob": None, "stream": "stdout", "outfile": None}
+            name = None
+
+            args = sys.argv[3:]
+            while len(args) > 0:
+                if args[0] == "--stderr":
+                    opts["stream"] = "stderr"
+                    args = args[1:]
+                elif args[0] in ("--grep", "--file", "--output", "--name") and len(args) > 1:
+                    if args[0] == "--name":
+                        name = args[1]
+                    else:
+                        opts[{"--grep": "pattern", "--file": "glob", "--output": "outfile"}[args[0]]] = args[1]
+                    args = args[2:]
+                elif args[0].startswith("--"):
+                    print(f"Unknown option {args[0]}")
+                    print(usage_str)
+                    sys.exit(1)
+                else:
+                    selectors.append(args[0])
+                    args = args[1:]
+
+            if len(selectors) == 0 or (opts["pattern"] is None and opts["glob"] is None):
+                print(usage_str)
+                sys.exit(1)
+
+            # unlike other commands, completed jobs on the machines are included
+            jids = []
+            for x in selectors:
+                if x.isdigit():
+                    jids.append(int(x))
+                else:
+                    names = select([x])
+                    jids += [jid for jid, job in jm.list().items()
+                             if job["machine"] in names and not job.get("requeued_as")]
+
+            jids = [jid for jid in dict.fromkeys(jids) if name is None or (jm.get(jid) or {}).get("name") == name]
+            job_collect(machines, jm, jids, **opts)
+
+        elif sys.argv[2] == "sync":
             try:
                 jid = int(sys.argv[3])
             except:
-                print("Usage: tinymon logs (id)")
+                print("Usage: tinymon sync (id)")
                 print("Specified job ID must be numeric")
                 sys.exit(1)
 
-            job_log(machines, jid, jm)
+            job_sync(machines, jid, jm)
 
-        elif sys.argv[2] == "kill":
+        elif sys.argv[2] == "logs":
             try:
                 jid = int(sys.argv[3])
             except:
-                print("Usage: tinymon kill (id)")
+                print("Usage: tinymon logs (id) [--stderr] [--grep PATTERN]")
                 print("Specified job ID must be numeric")
                 sys.exit(1)
 
-            job_kill(machines, jid, jm)
+            stream = "stdout"
+            pattern = None
+
+            opts = sys.argv[4:]
+            while len(opts) > 0:
+                if opts[0] == "--stderr":
+                    stream = "stderr"
+                    opts = opts[1:]
+                elif opts[0] == "--grep" and len(opts) > 1:
+                    pattern = opts[1]
+                    opts = opts[2:]
+                else:
+                    print("Usage: tinymon logs (id) [--stderr] [--grep PATTERN]")
+                    sys.exit(1)
+
+            job_log(machines, jid, jm, stream, pattern)
+
+        elif sys.argv[2] == "kill":
+            if len(sys.argv) < 4:
+                print("Usage: tinymon kill (id | machines) ...")
+                sys.exit(1)
+
+            if len(sys.argv) == 4 and sys.argv[3].isdigit():
+                job_kill(machines, int(sys.argv[3]), jm)
+            else:
+                job_kill_many(machines, select_jobs(sys.argv[3:]), jm)
+
+        else:
+            print(f"Invalid subcommand '{sys.argv[1]} {sys.argv[2]}'")
+            usage()
+
+    elif sys.argv[1] == "workflow":
+        if sys.argv[2] == "run":
+            try:
+                yamlfile = sys.argv[3]
+            except:
+                print("Usage: tinymon workflow run (workflow yaml)")
+                sys.exit(1)
+
+            workflow_run(machines, jm, yamlfile)
 
         else:
             print(f"Invalid subcommand '{sys.argv[1]} {sys.argv[2]}'")
             usage()
 
+    elif sys.argv[1] == "gc":
+        usage_str = "Usage: tinymon gc [machines] [--dry-run] [--archive] [--include-untracked] [--older-than 7d] [--min-size 0]"
+        selectors = []
+        opts = {"older_than": 7*86400, "min_size": 0, "dry_run": False, "archive": False, "include_untracked": False}
+
+        args = sys.argv[2:]
+        try:
+            while len(args) > 0:
+                if args[0] == "--dry-run":
+                    opts["dry_run"] = True
+                    args = args[1:]
+                elif args[0] == "--archive":
+                    opts["archive"] = True
+                    args = args[1:]
+                elif args[0] == "--include-untracked":
+                    opts["include_untracked"] = True
+                    args = args[1:]
+                elif args[0] == "--older-than" and len(args) > 1:
+                    opts["older_than"] = parse_duration(args[1])
+                    args = args[2:]
+                elif args[0] == "--min-size" and len(args) > 1:
+                    opts["min_size"] = parse_size(args[1])
+                    args = args[2:]
+                elif args[0].startswith("--"):
+                    raise AssertionError(f"Unknown option {args[0]}")
+                else:
+                    selectors.append(args[0])
+                    args = args[1:]
+
+        except AssertionError as e:
+            print(e)
+            print(usage_str)
+            sys.exit(1)
+
+        gc_run(machines, select(selectors or ["@all"]), jm, **opts)
+
+    elif sys.argv[1] == "serve-metrics":
+        usage_str = "Usage: tinymon serve-metrics [machines] [--port 9105] [--bind 127.0.0.1] [--interval 60]"
+        selectors = []
+        opts = {"host": "127.0.0.1", "port": 9105, "interval": 60}
+
+        args = sys.argv[2:]
+        try:
+            while len(args) > 0:
+                if args[0] == "--port" and len(args) > 1:
+                    assert args[1].isdigit(), f"Invalid port {args[1]}"
+                    opts["port"] = int(args[1])
+                    args = args[2:]
+                elif args[0] == "--bind" and len(args) > 1:
+                    opts["host"] = args[1]
+                    args = args[2:]
+                elif args[0] == "--interval" and len(args) > 1:
+                    opts["interval"] = parse_duration(args[1])
+                    args = args[2:]
+                elif args[0].startswith("--"):
+                    raise AssertionError(f"Unknown option {args[0]}")
+                else:
+                    selectors.append(args[0])
+                    args = args[1:]
+
+        except AssertionError as e:
+            print(e)
+            print(usage_str)
+            sys.exit(1)
+
+        serve_metrics({k: machines[k] for k in select(selectors or ["@all"])}, **opts)
+
     else:
         print(f"Invalid command '{sys.argv[1]}'")
         usage()
@@ -0,0 +1,114 @@
+"""
+tracing.py
+
+Lightweight timing spans for remote operations. Spans are only recorded
+once tracing has been enabled, and can be written out in the Chrome
+trace-event format (viewable in chrome://tracing or Perfetto) or
+summarized as a table of per-host, per-operation totals.
+
+Recording is thread-safe, so spans from concurrent fan-out across
+machines are captured on their own threads.
+"""
+from contextlib import contextmanager
+import threading
+import time
+import json
+
+_enabled = False
+_lock = threading.Lock()
+_spans = []
+_epoch = time.perf_counter()
+
+def enable():
+    global _enabled
+    _enabled = True
+
+def is_enabled():
+    return _enabled
+
+# Times the enclosed block as operation `name` against `host`. The yielded
+# dict can be filled in with extra details, such as "bytes" transferred.
+@contextmanager
+def span(name, host="local", **args):
+    if not _enabled:
+        yield args
+        return
+
+    start = time.perf_counter()
+    try:
+        yield args
+    finally:
+        end = time.perf_counter()
+        with _lock:
+            _spans.append((name, host, threading.get_ident(), start - _epoch, end - start, args))
+
+def get_spans():
+    with _lock:
+        return list(_spans)
+
+def write_chrome_trace(path):
+    spans = get_spans()
+
+    # each host is shown as its own process, with one track per thread
+    hosts = {}
+    events = []
+    for name, host, tid, start, dur, args in spans:
+        if host not in hosts:
+            hosts[host] = len(hosts) + 1
+            events.append({"name": "process_name", "ph": "M", "pid": hosts[host],
+                           "args": {"name": host}})
+
+        events.append({"name": name, "cat": host, "ph": "X",
+                       "ts": start * 1e6, "dur": dur * 1e6,
+                       "pid": hosts[host], "tid": tid, "args": args})
+
+    with open(path, "w+") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+def print_profile():
+    from .table_display import display_table
+
+    totals = {}
+    for name, host, tid, start, dur, args in get_spans():
+        calls, total, longest, nbytes = totals.get((host, name), (0, 0.0, 0.0, 0))
+        totals[(host, name)] = (calls + 1, total + dur, max(longest, dur),
+                                nbytes + args.get("bytes", 0))
+
+    col_names = ["Host", "Operation", "Calls", "Total", "Mean", "Max", "Bytes"]
+    rows = []
+    for (host, name), (calls, total, longest, nbytes) in sorted(totals.items(), key=lambda x: -x[1][1]):
+        rows.append([
+            host,
+            name,
+            str(calls),
+            f"{total:.3f}s",
+            f"{total / calls:.3f}s",
+            f"{longest:.3f}s",
+            _format_bytes(nbytes) if nbytes else ""
+        ])
+
+    if len(rows) == 0:
+        print("No operations were traced")
+    else:
+        display_table("Profile", col_names, rows)
+
+def _format_bytes(n):
+    for unit in ["B", "K", "M"]:
+        if n < 1024:
+            return f"{n:.0f}{unit}" if unit == "B" else f"{n:.1f}{unit}"
+        n /= 1024
+
+    return f"{n:.1f}G"
+
+# Unit-test
+if __name__ == "__main__":
+    enable()
+
+    with span("outer", "host-a"):
+        with span("inner", "host-a") as s:
+            time.sleep(0.01)
+            s["bytes"] = 1234
+
+    write_chrome_trace("/tmp/_tinymon_trace.json")
+    with open("/tmp/_tinymon_trace.json") as f:
+        print(f.read())
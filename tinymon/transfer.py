@@ -0,0 +1,62 @@
+"""
+transfer.py
+
+Utilities for moving files directly between two machines, without
+relaying them through the machine running tinymon. Files on storage which
+both machines share are copied (or used) in place; otherwise they are
+streamed from one machine to the other with tar over SSH.
+"""
+from .machine_config import DirType, MachineType
+from .machine_access import get_access
+from . import tracing
+import os
+import shlex
+
+# Whether a path in the workdir of machine `a` can be read at the same path on machine `b`
+def shares_storage(a, b):
+    if a.name == b.name:
+        return True
+
+    if a.machine_type == MachineType.LOCAL and b.machine_type == MachineType.LOCAL:
+        return True
+
+    return a.workdir_type in (DirType.SHARED_DISK, DirType.AFS) and \
+           a.workdir_type == b.workdir_type and a.workdir == b.workdir
+
+# Whether `path` on machine `src` can be read as-is from machine `dst`
+def readable_in_place(src, path, dst):
+    if src.name == dst.name:
+        return True
+
+    # anything outside of the workdir (i.e. under tmpdir) is on local disk
+    workdir = os.path.abspath(src.workdir)
+    in_workdir = os.path.commonpath([os.path.abspath(path), workdir]) == workdir
+    return in_workdir and shares_storage(src, dst)
+
+# Copies `name` (a file or directory relative to `src_dir`, or "." for all of
+# its contents) from machine `src` into `dst_dir` on machine `dst`
+def copy_between(src, src_dir, name, dst, dst_dir):
+    mkdir = f"mkdir -p {shlex.quote(dst_dir)}"
+
+    if readable_in_place(src, src_dir, dst):
+        runner = dst
+        cmd = f"{mkdir} && cp -R {shlex.quote(os.path.join(src_dir, name))} {shlex.quote(dst_dir)}"
+
+    else:
+        pack = f"tar -C {shlex.quote(src_dir)} -cf - {shlex.quote(name)}"
+        unpack = f"{mkdir} && tar -C {shlex.quote(dst_dir)} -xf -"
+
+        # the other end must be reachable by SSH key from whichever machine
+        # runs the transfer, as there is no way to enter a password
+        if src.machine_type == MachineType.LOCAL:
+            runner = src
+            cmd = f"{pack} | ssh -o BatchMode=yes -o ConnectTimeout=10 {dst.username}@{dst.host} {shlex.quote(unpack)}"
+        else:
+            runner = dst
+            cmd = f"ssh -o BatchMode=yes -o ConnectTimeout=10 {src.username}@{src.host} {shlex.quote(pack)} | sh -c {shlex.quote(unpack)}"
+
+    with tracing.span("copy_between", dst.name, src=src.name), get_access(runner) as m:
+        out, status = m.run_to_end(cmd)
+
+    if not isinstance(out, str): out = out.decode()
+    return status == 0, out
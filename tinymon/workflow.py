@@ -0,0 +1,176 @@
+"""
+workflow.py
+
+Provides data structures for multi-stage workflows, where each stage is a
+job that may depend on the results of earlier stages, and the orchestration
+loop which runs them.
+
+Artifacts (the results directory of a stage) are never relayed through the
+local machine. When two stages run on machines which share storage the
+dependent stage reads the artifact in place, otherwise it is streamed
+directly from one machine to the other over SSH.
+"""
+from dataclasses import dataclass
+from .job_manager import job_start, job_poll, job_failed, final_jid
+from .transfer import readable_in_place, copy_between
+import os
+import sys
+import time
+import yaml
+
+@dataclass
+class StageConfig:
+    name: str
+    jobfile: str
+    machine: str
+    args: dict
+    depends: list
+    inputs: dict # template variable name -> stage whose results are passed in
+
+    @classmethod
+    def parseconfig(cls, name, cfg, basedir):
+        assert "job" in cfg, f"Stage {name} must have a 'job' parameter"
+        assert "machine" in cfg, f"Stage {name} must have a 'machine' parameter"
+
+        inputs = cfg.get("inputs", {})
+        depends = list(cfg.get("depends", []))
+
+        # a stage always depends on the stages it takes inputs from
+        for stage in inputs.values():
+            if stage not in depends:
+                depends.append(stage)
+
+        return cls(name, os.path.join(basedir, cfg["job"]), cfg["machine"],
+                   {k: str(v) for k, v in cfg.get("args", {}).items()},
+                   depends, inputs)
+
+@dataclass
+class WorkflowConfig:
+    name: str
+    stages: dict
+
+    @classmethod
+    def parseconfig(cls, cfg, basedir):
+        assert "name" in cfg, "Workflows must have a 'name' parameter"
+        assert "stages" in cfg, "Workflows must have a 'stages' parameter"
+
+        stages = {k: StageConfig.parseconfig(k, v, basedir) for k, v in cfg["stages"].items()}
+
+        for stage in stages.values():
+            for dep in stage.depends:
+                assert dep in stages, f"Stage {stage.name} depends on unknown stage {dep}"
+
+        wf = cls(cfg["name"], stages)
+        wf.topological_order()
+        return wf
+
+    @classmethod
+    def parsefile(cls, path):
+        with open(path) as f:
+            data = yaml.load(f, yaml.Loader)
+
+        return cls.parseconfig(data, os.path.dirname(path))
+
+    # Also serves to check that the dependency graph is acyclic
+    def topological_order(self):
+        order = []
+        visiting = set()
+        done = set()
+
+        def visit(name):
+            if name in done: return
+            assert name not in visiting, f"Workflow {self.name} has a dependency cycle through stage {name}"
+
+            visiting.add(name)
+            for dep in self.stages[name].depends:
+                visit(dep)
+
+            visiting.remove(name)
+            done.add(name)
+            order.append(name)
+
+        for name in self.stages:
+            visit(name)
+
+        return order
+
+# Makes the results of a finished job available on `dst`, returning the path
+# on `dst` which holds them
+def handoff_artifact(machines, src_state, dst):
+    src = machines[src_state["machine"]]
+    path = src_state["results_dir"]
+
+    if readable_in_place(src, path, dst):
+        return path
+
+    dest = os.path.join(dst.workdir, f"artifacts-{src_state['id']}/")
+    print(f"Transferring results of job ID {src_state['id']} from {src.name} to {dst.name}")
+
+    ok, out = copy_between(src, path, ".", dst, dest)
+    assert ok, f"Failed to transfer results of job ID {src_state['id']} to {dst.name}: {out}"
+
+    return dest
+
+def workflow_run(machines, jm, wffile, poll_interval=10):
+    wf = WorkflowConfig.parsefile(wffile)
+
+    for stage in wf.stages.values():
+        if stage.machine not in machines:
+            print(f"Error: stage {stage.name} uses unknown machine {stage.machine}")
+            sys.exit(1)
+
+    print(f"Running workflow {wf.name} with stages {', '.join(wf.topological_order())}")
+
+    running = {} # stage name -> jid
+    finished = {} # stage name -> jid
+
+    while len(finished) < len(wf.stages):
+        for name in wf.topological_order():
+            stage = wf.stages[name]
+            if name in running or name in finished: continue
+            if not all(dep in finished for dep in stage.depends): continue
+
+            args = dict(stage.args)
+            for var, dep in stage.inputs.items():
+                dep_state = jm.get(finished[dep])
+                assert dep_state["results_dir"] is not None, \
+                        f"Stage {dep} does not have a results directory to pass to stage {name}"
+                args[var] = handoff_artifact(machines, dep_state, machines[stage.machine])
+
+            print(f"Starting stage {name}")
+            running[name] = job_start(machines, jm, stage.machine, stage.jobfile, args)
+
+        # every stage left waits on a stage which will never finish
+        if len(running) == 0:
+            waiting = [name for name in wf.stages if name not in finished]
+            print(f"Error: stages {', '.join(waiting)} can never be started, as their dependencies can't complete")
+            sys.exit(1)
+
+        time.sleep(poll_interval)
+
+        for name, jid in list(running.items()):
+            if not job_poll(machines, jid, jm):
+                jid = final_jid(jm, jid)
+                if job_failed(jm.get(jid)):
+                    print(f"Error: stage {name} (job ID {jid}) failed with exit code {jm.get(jid)['exit_code']}")
+                    sys.exit(1)
+
+                print(f"Stage {name} (job ID {jid}) has completed")
+                running.pop(name)
+                finished[name] = jid
+
+    print(f"Workflow {wf.name} has completed")
+    return finished
+
+# Unit-test
+if __name__ == "__main__":
+    wf = WorkflowConfig.parseconfig({
+        "name": "pipeline",
+        "stages": {
+            "evaluate": {"job": "eval.yaml", "machine": "a", "inputs": {"model": "train"}},
+            "train": {"job": "train.yaml", "machine": "b", "inputs": {"data": "preprocess"}},
+            "preprocess": {"job": "pre.yaml", "machine": "a"},
+        }
+    }, "test_data")
+
+    print(wf.topological_order())